@@ -0,0 +1,855 @@
+#!/usr/bin/env python
+"""
+Offline benchmark for the Semantic Guidance denoiser callback
+
+Loads scripts/sega.py against a lightweight stand-in for the webui `modules` package, so no WebUI, model or GPU
+is needed, and drives on_cfg_denoiser_callback with synthetic SD 1.5 / SD XL conditioning shapes.
+Every combination of model, concept count, batch size, token length and dtype is measured, and the results are
+written as JSON so runs can be compared for regressions.
+
+        python benchmarks/benchmark_sega.py --models sd15 sdxl --concepts 1 4 8 --batch-sizes 1 4 --output bench.json
+
+Scenarios (--scenarios):
+        sweep: per-step latency, allocations and peak memory for every configuration
+        jobs: runs --jobs short jobs that complete, get interrupted or fail, and samples the registered callback count,
+              the number of live SEGA jobs and live tensor memory, which should all stay flat
+        sparse: per-step latency of the dense and the sparse guidance path over --tail-thresholds for the
+                --sparse-threshold-modes, with the measured fraction of selected elements and the largest difference
+                between both paths
+        thresholds: per-step latency and fraction of selected elements of every threshold mode over --tail-thresholds,
+                    with the error of the Gaussian and Approximate modes relative to the Exact percentile
+        grid: an XYZ-style --grid-size x --grid-size sweep of edit guidance scale and tail threshold with scheduled concept
+              prompts and a hires-fix second pass per cell, counting concept encodings and concept tensor builds with and
+              without the caches shared across generations
+        noise: per-step latency of a whole denoiser step through a tiny stub denoiser with SEGA off, in embedding space and
+               in noise space, which adds a row per concept and image to the batched denoiser forward
+        prefetch: scheduled concept prompts that switch at staggered steps through a slow stub denoiser, with and without
+                  background prefetch, reporting the time spent getting the concept tensors at segment boundaries
+
+Allocation counts and peak memory come from the CUDA caching allocator on GPU. On CPU they are approximated from
+the torch profiler memory events, attributed to the op that made them.
+"""
+import argparse
+import gc
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+import types
+import warnings
+import zlib
+from collections import namedtuple
+
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEGA_PATH = os.path.join(REPO_ROOT, 'scripts', 'sega.py')
+
+# conditioning width of the supported model families, vector is the pooled SD XL conditioning
+MODEL_SHAPES = {
+        'sd15': {'crossattn': 768, 'vector': None},
+        'sdxl': {'crossattn': 2048, 'vector': 2816},
+}
+
+CALLBACK_NAMES = ('cfg_denoiser', 'cfg_denoised', 'cfg_after_cfg', 'script_unloaded', 'before_ui', 'model_loaded', 'ui_settings')
+
+
+class DictWithShape(dict):
+        """ SD XL conditioning dict that reports the shape of its crossattn tensor, as in the webui """
+        def __init__(self, x, shape=None):
+                super().__init__()
+                self.update(x)
+
+        @property
+        def shape(self):
+                return self['crossattn'].shape
+
+
+class StubModel:
+        """ Stand-in for shared.sd_model with a deterministic synthetic text encoder """
+        def __init__(self, model: str, dtype: torch.dtype, device: torch.device):
+                self.model = model
+                self.dim = MODEL_SHAPES[model]['crossattn']
+                self.vector_dim = MODEL_SHAPES[model]['vector']
+                self.dtype = dtype
+                self.device = device
+                self.sd_model_hash = f'stub-{model}-{str(dtype).replace("torch.", "")}'
+                self.cond_stage_model_empty_prompt = torch.zeros((1, 77, self.dim), dtype=dtype, device=device)
+                self.encoded_prompts = 0
+
+        def encode(self, prompt: str, tokens: int = 77):
+                self.encoded_prompts += 1
+                generator = torch.Generator().manual_seed(zlib.crc32(prompt.encode()))
+                crossattn = torch.randn((tokens, self.dim), generator=generator).to(dtype=self.dtype, device=self.device)
+                if self.vector_dim is None:
+                        return crossattn
+                vector = torch.randn((self.vector_dim,), generator=generator).to(dtype=self.dtype, device=self.device)
+                return {'crossattn': crossattn, 'vector': vector}
+
+        def batched(self, prompt: str, batch_size: int, tokens: int):
+                """ Conditioning for a whole image batch, shaped like CFGDenoiserParams.text_cond """
+                cond = self.encode(prompt, tokens)
+                if isinstance(cond, dict):
+                        return DictWithShape({key: tensor.unsqueeze(0).repeat((batch_size,) + (1,) * tensor.dim()) for key, tensor in cond.items()})
+                return cond.unsqueeze(0).repeat(batch_size, 1, 1)
+
+
+def copy_cond(cond):
+        """ Copy of a conditioning tensor or dict that the denoiser callback can modify in-place """
+        if isinstance(cond, dict):
+                return DictWithShape({key: tensor.clone() for key, tensor in cond.items()})
+        return cond.clone()
+
+
+def make_script_callbacks():
+        module = types.ModuleType('modules.script_callbacks')
+        module.callback_map = {name: [] for name in CALLBACK_NAMES}
+
+        class CFGDenoiserParams:
+                def __init__(self, x, image_cond, sigma, sampling_step, total_sampling_steps, text_cond, text_uncond, denoiser=None):
+                        self.x = x
+                        self.image_cond = image_cond
+                        self.sigma = sigma
+                        self.sampling_step = sampling_step
+                        self.total_sampling_steps = total_sampling_steps
+                        self.text_cond = text_cond
+                        self.text_uncond = text_uncond
+                        self.denoiser = denoiser
+
+        class CFGDenoisedParams:
+                def __init__(self, x, sampling_step, total_sampling_steps, inner_model):
+                        self.x = x
+                        self.sampling_step = sampling_step
+                        self.total_sampling_steps = total_sampling_steps
+                        self.inner_model = inner_model
+
+        class AfterCFGCallbackParams:
+                def __init__(self, x, sampling_step, total_sampling_steps):
+                        self.x = x
+                        self.sampling_step = sampling_step
+                        self.total_sampling_steps = total_sampling_steps
+
+        def make_register(name):
+                def register(callback):
+                        # like the webui, remember which file registered the callback
+                        module.callback_map[name].append((sys._getframe(1).f_code.co_filename, callback))
+                return register
+
+        def make_dispatch(name):
+                def dispatch(*args):
+                        for _, callback in list(module.callback_map[name]):
+                                callback(*args)
+                return dispatch
+
+        def remove_current_script_callbacks():
+                filename = sys._getframe(1).f_code.co_filename
+                for callbacks in module.callback_map.values():
+                        callbacks[:] = [x for x in callbacks if x[0] != filename]
+
+        def callback_count():
+                return sum(len(callbacks) for callbacks in module.callback_map.values())
+
+        for name in CALLBACK_NAMES:
+                setattr(module, f'on_{name}', make_register(name))
+                setattr(module, f'{name}_callback', make_dispatch(name))
+        module.CFGDenoiserParams = CFGDenoiserParams
+        module.CFGDenoisedParams = CFGDenoisedParams
+        module.AfterCFGCallbackParams = AfterCFGCallbackParams
+        module.remove_current_script_callbacks = remove_current_script_callbacks
+        module.callback_count = callback_count
+        return module
+
+
+def make_prompt_parser():
+        module = types.ModuleType('modules.prompt_parser')
+        ScheduledPromptConditioning = namedtuple('ScheduledPromptConditioning', ['end_at_step', 'cond'])
+
+        class ComposableScheduledPromptConditioning:
+                def __init__(self, schedules, weight=1.0):
+                        self.schedules = schedules
+                        self.weight = weight
+
+        class MulticondLearnedConditioning:
+                def __init__(self, shape, batch):
+                        self.shape = shape
+                        self.batch = batch
+
+        class SdConditioning(list):
+                def __init__(self, prompts, is_negative_prompt=False, width=None, height=None, copy_from=None):
+                        super().__init__()
+                        self.extend(prompts)
+                        self.is_negative_prompt = is_negative_prompt
+                        self.width = width
+                        self.height = height
+
+        def get_learned_schedules(prompt, steps):
+                # only a single top-level [from:to:when], enough to benchmark prompt-schedule segments
+                match = re.fullmatch(r'\[([^:\[\]]*):([^:\[\]]*):([0-9.]+)\]', prompt)
+                if match is None:
+                        return [(steps, prompt)]
+                before, after, when = match.group(1), match.group(2), float(match.group(3))
+                end_at_step = int(when * steps) if when < 1 else int(when)
+                return [(end_at_step, before), (steps, after)]
+
+        def get_multicond_learned_conditioning(model, prompts, steps, *args, **kwargs):
+                batch = []
+                for prompt in prompts:
+                        schedules = [ScheduledPromptConditioning(end_at_step, model.encode(text)) for end_at_step, text in get_learned_schedules(prompt, steps)]
+                        batch.append([ComposableScheduledPromptConditioning(schedules)])
+                return MulticondLearnedConditioning(shape=(len(prompts),), batch=batch)
+
+        def stack_conds(tensors):
+                token_count = max(x.shape[0] for x in tensors)
+                for i in range(len(tensors)):
+                        if tensors[i].shape[0] != token_count:
+                                last_vector_repeated = tensors[i][-1:].repeat([token_count - tensors[i].shape[0], 1])
+                                tensors[i] = torch.vstack([tensors[i], last_vector_repeated])
+                return torch.stack(tensors)
+
+        def reconstruct_multicond_batch(c, current_step):
+                tensors = []
+                conds_list = []
+                for composable_prompts in c.batch:
+                        conds_for_batch = []
+                        for composable_prompt in composable_prompts:
+                                target_index = 0
+                                for current, entry in enumerate(composable_prompt.schedules):
+                                        if current_step <= entry.end_at_step:
+                                                target_index = current
+                                                break
+                                conds_for_batch.append((len(tensors), composable_prompt.weight))
+                                tensors.append(composable_prompt.schedules[target_index].cond)
+                        conds_list.append(conds_for_batch)
+                if isinstance(tensors[0], dict):
+                        stacked = DictWithShape({key: stack_conds([x[key] for x in tensors]) for key in tensors[0].keys()})
+                else:
+                        stacked = stack_conds(tensors)
+                return conds_list, stacked
+
+        def parse_prompt_attention(text):
+                match = re.fullmatch(r'\((.*):([0-9.]+)\)', text)
+                if match is not None:
+                        return [[match.group(1), float(match.group(2))]]
+                return [[text, 1.0]]
+
+        module.ScheduledPromptConditioning = ScheduledPromptConditioning
+        module.ComposableScheduledPromptConditioning = ComposableScheduledPromptConditioning
+        module.MulticondLearnedConditioning = MulticondLearnedConditioning
+        module.SdConditioning = SdConditioning
+        module.get_multicond_learned_conditioning = get_multicond_learned_conditioning
+        module.reconstruct_multicond_batch = reconstruct_multicond_batch
+        module.parse_prompt_attention = parse_prompt_attention
+        return module
+
+
+def install_stub_modules():
+        """ Register the stand-in `modules` package, returns the dict of stub modules """
+        shared = types.ModuleType('modules.shared')
+        shared.sd_model = None
+        shared.opts = types.SimpleNamespace(CLIP_stop_at_last_layers=1, s_min_uncond=0.0)
+        shared.state = types.SimpleNamespace(interrupted=False, skipped=False)
+
+        scripts = types.ModuleType('modules.scripts')
+        scripts.Script = type('Script', (), {})
+        scripts.AlwaysVisible = object()
+        scripts.scripts_data = []
+
+        processing = types.ModuleType('modules.processing')
+
+        class StableDiffusionProcessing:
+                def __init__(self, batch_size: int, steps: int, width: int = 1024, height: int = 1024):
+                        self.batch_size = batch_size
+                        self.steps = steps
+                        self.width = width
+                        self.height = height
+                        self.extra_network_data = {}
+                        self.extra_generation_params = {}
+
+                def get_conds_with_caching(self, function, required_prompts, steps, caches, extra_network_data, hires_steps=None):
+                        return function(shared.sd_model, required_prompts, steps)
+
+        processing.StableDiffusionProcessing = StableDiffusionProcessing
+
+        sd_samplers_cfg_denoiser = types.ModuleType('modules.sd_samplers_cfg_denoiser')
+
+        def pad_cond(tensor, repeats, empty):
+                if not isinstance(tensor, dict):
+                        return torch.cat([tensor, empty.repeat((tensor.shape[0], repeats, 1)).to(device=tensor.device)], axis=1)
+                tensor['crossattn'] = pad_cond(tensor['crossattn'], repeats, empty)
+                return tensor
+
+        sd_samplers_cfg_denoiser.pad_cond = pad_cond
+
+        stubs = {
+                'modules.shared': shared,
+                'modules.scripts': scripts,
+                'modules.processing': processing,
+                'modules.script_callbacks': make_script_callbacks(),
+                'modules.prompt_parser': make_prompt_parser(),
+                'modules.sd_samplers_cfg_denoiser': sd_samplers_cfg_denoiser,
+        }
+        package = types.ModuleType('modules')
+        package.__path__ = []
+        sys.modules['modules'] = package
+        for name, module in stubs.items():
+                sys.modules[name] = module
+                setattr(package, name.split('.', 1)[1], module)
+
+        # gradio is only used to build the UI
+        try:
+                import gradio # noqa: F401
+        except ImportError:
+                sys.modules['gradio'] = types.ModuleType('gradio')
+        return stubs
+
+
+def load_sega():
+        stubs = install_stub_modules()
+        spec = importlib.util.spec_from_file_location('sega', SEGA_PATH)
+        sega = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(sega)
+        return sega, stubs
+
+
+def synchronize(device: torch.device):
+        if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+
+
+def measure_memory(step, steps: int, device: torch.device) -> dict:
+        """ Allocation count, allocated bytes per step and peak memory above the starting point while running `step` """
+        if device.type == 'cuda':
+                synchronize(device)
+                base_allocated = torch.cuda.memory_allocated(device)
+                torch.cuda.reset_peak_memory_stats(device)
+                before = torch.cuda.memory_stats(device)
+                for i in range(steps):
+                        step(i)
+                synchronize(device)
+                after = torch.cuda.memory_stats(device)
+                return {
+                        'allocations_per_step': (after['allocation.all.allocated'] - before['allocation.all.allocated']) / steps,
+                        'allocated_bytes_per_step': (after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated']) / steps,
+                        'peak_bytes': torch.cuda.max_memory_allocated(device) - base_allocated,
+                }
+
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+                for i in range(steps):
+                        step(i)
+        memory_events = sorted(
+                (event.time_range.start, event.self_cpu_memory_usage)
+                for event in prof.events()
+                if event.self_cpu_memory_usage != 0
+        )
+        current = 0
+        peak = 0
+        for _, nbytes in memory_events:
+                current += nbytes
+                peak = max(peak, current)
+        return {
+                'allocations_per_step': sum(1 for _, nbytes in memory_events if nbytes > 0) / steps,
+                'allocated_bytes_per_step': sum(nbytes for _, nbytes in memory_events if nbytes > 0) / steps,
+                'peak_bytes': peak,
+        }
+
+
+def latency_stats(latencies: list) -> dict:
+        latencies = sorted(latencies)
+        return {
+                'mean_ms': statistics.fmean(latencies) * 1000,
+                'median_ms': statistics.median(latencies) * 1000,
+                'p90_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))] * 1000,
+                'min_ms': latencies[0] * 1000,
+        }
+
+
+class BenchmarkJob:
+        """ A single SEGA generation driven through process_batch / postprocess_batch of the stub runtime """
+        def __init__(self, sega, stubs, config: dict, device: torch.device, sega_params: dict = None):
+                self.sega = sega
+                self.stubs = stubs
+                self.config = config
+                self.device = device
+                self.callbacks = stubs['modules.script_callbacks']
+                model = stubs['modules.shared'].sd_model
+
+                self.script = sega.SegaExtensionScript()
+                self.p = stubs['modules.processing'].StableDiffusionProcessing(config['batch_size'], config['steps'])
+                self.p.sega_active = True
+                self.p.sega_prompt = ', '.join(config.get('concept_prompts', [f'concept {i}' for i in range(config['num_concepts'])]))
+                self.p.sega_neg_prompt = ''
+                self.p.sega_warmup = 0
+                self.p.sega_cooldown = -1
+                self.p.sega_edit_guidance_scale = 1.0
+                self.p.sega_tail_percentage_threshold = 0.05
+                self.p.sega_threshold_mode = 'Gaussian'
+                self.p.sega_momentum_scale = 0.3
+                self.p.sega_momentum_beta = 0.6
+                self.p.sega_guidance_space = 'Embedding'
+                for name, value in (sega_params or {}).items():
+                        setattr(self.p, f'sega_{name}', value)
+
+                self.text_cond = model.batched('a photo of a cat', config['batch_size'], config['tokens'])
+                self.text_uncond = model.batched('', config['batch_size'], config['tokens'])
+                self.x = torch.zeros((config['batch_size'] * 2, 4, 8, 8), dtype=model.dtype, device=device)
+
+        def start(self):
+                # all UI arguments are overridden by the p.sega_* attributes
+                self.script.process_batch(self.p, *[None] * 16)
+
+        def step(self, sampling_step: int):
+                # the callback adds to the conditioning in-place, so every step starts from a copy, as the webui reconstructs it every step
+                text_cond = copy_cond(self.text_cond)
+                params = self.callbacks.CFGDenoiserParams(self.x, None, None, sampling_step % self.config['steps'], self.config['steps'], text_cond, self.text_uncond)
+                self.callbacks.cfg_denoiser_callback(params)
+                return params
+
+        def finish(self):
+                self.script.postprocess_batch(self.p, None, None)
+
+
+class StubDenoiser:
+        """
+        Minimal stand-in for the webui CFGDenoiser: cond and uncond rows go through a single inner model call, cond rows
+        are taken from the front and uncond rows from the back of its output, and the cfg callbacks fire around it
+        As in the webui, every other call below shared.opts.s_min_uncond skips the uncond rows and reuses the cond prediction
+        The inner model is a cheap function of the latent, sigma and conditioning, plus an optional simulated cost per row
+        """
+        def __init__(self, callbacks, p, cond_scale: float = 7.0, unet_ms_per_row: float = 0.0):
+                self.callbacks = callbacks
+                self.p = p
+                self.cond_scale = cond_scale
+                self.unet_ms_per_row = unet_ms_per_row
+                self.rows = 0
+                self.callback_time = 0.0
+                self.step = 0
+
+        def inner_model(self, x, sigma, cond):
+                crossattn = cond['crossattn'] if isinstance(cond, dict) else cond
+                self.rows = x.shape[0]
+                if self.unet_ms_per_row > 0:
+                        time.sleep(self.unet_ms_per_row * x.shape[0] / 1000)
+                # the conditioning scales every latent channel, so concept and uncond rows differ per element
+                channel_scale = crossattn.mean(dim=1)[:, :x.shape[1]].view(x.shape[0], -1, 1, 1)
+                return x * (1 / (sigma.view(-1, 1, 1, 1) ** 2 + 1) + channel_scale)
+
+        def __call__(self, x, sigma, sampling_step: int, total_sampling_steps: int, text_cond, text_uncond):
+                batch_size = x.shape[0]
+                text_cond = copy_cond(text_cond)
+                params = self.callbacks.CFGDenoiserParams(torch.cat([x, x]), None, torch.cat([sigma, sigma]), sampling_step, total_sampling_steps, text_cond, text_uncond, self)
+                start = time.perf_counter()
+                self.callbacks.cfg_denoiser_callback(params)
+                self.callback_time = time.perf_counter() - start
+
+                x_in, sigma_in = params.x, params.sigma
+                s_min_uncond = sys.modules['modules.shared'].opts.s_min_uncond
+                skip_uncond = self.step % 2 and s_min_uncond > 0 and sigma[0] < s_min_uncond
+                if skip_uncond:
+                        x_in, sigma_in = x_in[:-batch_size], sigma_in[:-batch_size]
+                        cond_in = params.text_cond
+                elif isinstance(params.text_cond, dict):
+                        cond_in = {key: torch.cat([tensor, params.text_uncond[key]]) for key, tensor in params.text_cond.items()}
+                else:
+                        cond_in = torch.cat([params.text_cond, params.text_uncond])
+                x_out = self.inner_model(x_in, sigma_in, cond_in)
+                if skip_uncond:
+                        x_out = torch.cat([x_out, x_out[:batch_size]])
+                self.callbacks.cfg_denoised_callback(self.callbacks.CFGDenoisedParams(x_out, sampling_step, total_sampling_steps, self))
+
+                denoised_uncond = x_out[-batch_size:]
+                denoised = denoised_uncond + (x_out[:batch_size] - denoised_uncond) * self.cond_scale
+                after_cfg_params = self.callbacks.AfterCFGCallbackParams(denoised, sampling_step, total_sampling_steps)
+                self.callbacks.cfg_after_cfg_callback(after_cfg_params)
+                self.step += 1
+                return after_cfg_params.x
+
+
+def run_config(sega, stubs, config: dict, args) -> dict:
+        device = torch.device(args.device)
+        shared = stubs['modules.shared']
+        shared.sd_model = StubModel(config['model'], getattr(torch, config['dtype']), device)
+        sega.SEGA_MEMORY_BUDGET_MB = config['memory_budget_mb']
+
+        job = BenchmarkJob(sega, stubs, config, device)
+        job.start()
+        for i in range(args.warmup):
+                job.step(i)
+
+        latencies = []
+        for i in range(config['steps']):
+                synchronize(device)
+                start = time.perf_counter()
+                job.step(i)
+                synchronize(device)
+                latencies.append(time.perf_counter() - start)
+
+        memory = measure_memory(job.step, config['steps'], device)
+        job.finish()
+        return {**config, **latency_stats(latencies), **memory}
+
+
+def run_sparse(sega, stubs, args) -> list:
+        """ Compare dense and sparse guidance over a range of tail thresholds for the percentile threshold modes """
+        device = torch.device(args.device)
+        sega.SEGA_MEMORY_BUDGET_MB = 0
+        results = []
+        sweep = itertools.product(args.models, args.concepts, args.batch_sizes, args.tokens, args.dtypes, args.sparse_threshold_modes, args.tail_thresholds)
+        for model, num_concepts, batch_size, tokens, dtype, threshold_mode, threshold in sweep:
+                stubs['modules.shared'].sd_model = StubModel(model, getattr(torch, dtype), device)
+                config = {'model': model, 'num_concepts': num_concepts, 'batch_size': batch_size, 'tokens': tokens, 'dtype': dtype, 'threshold_mode': threshold_mode, 'tail_percentage_threshold': threshold, 'steps': args.steps}
+                outputs = {}
+                for mode, density in (('dense', 0.0), ('sparse', 1.0)):
+                        # 0 keeps every job on the dense path, 1 never switches the sparse path over to dense
+                        sega.SEGA_SPARSE_DENSITY = density
+                        job = BenchmarkJob(sega, stubs, config, device, {'tail_percentage_threshold': threshold, 'threshold_mode': threshold_mode})
+                        job.start()
+                        for i in range(args.warmup):
+                                job.step(i)
+
+                        stats = sega.sega_jobs.jobs[id(job.p)].profiler.stats = {}
+                        latencies = []
+                        for i in range(config['steps']):
+                                synchronize(device)
+                                start = time.perf_counter()
+                                params = job.step(i)
+                                synchronize(device)
+                                latencies.append(time.perf_counter() - start)
+                        outputs[mode] = params.text_cond
+                        job.finish()
+                        config[mode] = latency_stats(latencies)
+                        config['density'] = float(stats['selected_elements']) / stats['total_elements']
+
+                # sd 1.5 conditionings are plain tensors
+                outputs = {mode: output if isinstance(output, dict) else {'crossattn': output} for mode, output in outputs.items()}
+                config['max_abs_diff'] = max(float((outputs['dense'][key] - outputs['sparse'][key]).abs().max()) for key in outputs['dense'])
+                results.append(config)
+                print(f"{model} concepts={num_concepts} batch={batch_size} tokens={tokens} {dtype} {threshold_mode} threshold={threshold}: density {config['density']:.4f}, dense {config['dense']['median_ms']:.3f} ms/step, sparse {config['sparse']['median_ms']:.3f} ms/step", file=sys.stderr)
+        return results
+
+
+def run_thresholds(sega, stubs, args) -> list:
+        """ Compare the threshold modes against the exact percentile over a range of tail thresholds """
+        device = torch.device(args.device)
+        sega.SEGA_MEMORY_BUDGET_MB = 0
+        sega.SEGA_SPARSE_DENSITY = 0
+        results = []
+        sweep = itertools.product(args.models, args.concepts, args.batch_sizes, args.tokens, args.dtypes, args.tail_thresholds)
+        for model, num_concepts, batch_size, tokens, dtype, threshold in sweep:
+                stubs['modules.shared'].sd_model = StubModel(model, getattr(torch, dtype), device)
+                config = {'model': model, 'num_concepts': num_concepts, 'batch_size': batch_size, 'tokens': tokens, 'dtype': dtype, 'tail_percentage_threshold': threshold, 'steps': args.steps}
+                for mode in sega.THRESHOLD_MODES:
+                        job = BenchmarkJob(sega, stubs, config, device, {'tail_percentage_threshold': threshold, 'threshold_mode': mode})
+                        job.start()
+                        for i in range(args.warmup):
+                                job.step(i)
+
+                        stats = sega.sega_jobs.jobs[id(job.p)].profiler.stats = {}
+                        latencies = []
+                        for i in range(config['steps']):
+                                synchronize(device)
+                                start = time.perf_counter()
+                                job.step(i)
+                                synchronize(device)
+                                latencies.append(time.perf_counter() - start)
+                        job.finish()
+                        config[mode] = {**latency_stats(latencies), 'density': float(stats['selected_elements']) / stats['total_elements']}
+
+                exact_density = config['Exact']['density']
+                for mode in sega.THRESHOLD_MODES:
+                        config[mode]['density_error'] = abs(config[mode]['density'] - exact_density) / max(exact_density, 1e-12)
+                results.append(config)
+                summary = ', '.join(f"{mode} {config[mode]['median_ms']:.3f} ms/step density {config[mode]['density']:.4f}" for mode in sega.THRESHOLD_MODES)
+                print(f"{model} concepts={num_concepts} batch={batch_size} tokens={tokens} {dtype} threshold={threshold}: {summary}", file=sys.stderr)
+        return results
+
+
+def run_grid(sega, stubs, args) -> dict:
+        """ Run a parameter sweep where only numeric SEGA parameters change between cells, each cell with a hires-fix pass """
+        device = torch.device(args.device)
+        prompt_parser = stubs['modules.prompt_parser']
+        stubs['modules.shared'].sd_model = StubModel('sdxl', torch.float32, device)
+        sega.SEGA_MEMORY_BUDGET_MB = 0
+        sega.SEGA_SPARSE_DENSITY = 0
+        config = {'model': 'sdxl', 'num_concepts': 4, 'batch_size': 1, 'tokens': 77, 'dtype': 'float32', 'steps': args.steps}
+        config['concept_prompts'] = [f'[concept {i}:other concept {i}:0.5]' for i in range(config['num_concepts'])]
+        cells = list(itertools.product(torch.linspace(0.5, 2.5, args.grid_size).tolist(), torch.linspace(0.01, 0.2, args.grid_size).tolist()))
+
+        counts = {'encodings': 0, 'builds': 0}
+        get_multicond_learned_conditioning = prompt_parser.get_multicond_learned_conditioning
+        build = sega.SegaConceptStore.build
+
+        def counting_encode(*args, **kwargs):
+                counts['encodings'] += 1
+                return get_multicond_learned_conditioning(*args, **kwargs)
+
+        def counting_build(self, *args, **kwargs):
+                counts['builds'] += 1
+                return build(self, *args, **kwargs)
+
+        prompt_parser.get_multicond_learned_conditioning = counting_encode
+        sega.SegaConceptStore.build = counting_build
+        results = {}
+        try:
+                for mode in ('uncached', 'cached'):
+                        sega.concept_cond_cache.clear()
+                        sega.concept_store_cache.clear()
+                        counts.update(encodings=0, builds=0)
+                        start = time.perf_counter()
+                        for edit_guidance_scale, tail_percentage_threshold in cells:
+                                if mode == 'uncached':
+                                        # every cell starts from scratch, as if nothing was shared across generations
+                                        sega.concept_cond_cache.clear()
+                                        sega.concept_store_cache.clear()
+                                job = BenchmarkJob(sega, stubs, config, device, {'edit_guidance_scale': edit_guidance_scale, 'tail_percentage_threshold': tail_percentage_threshold, 'warmup': 0})
+                                job.start()
+                                # the hires-fix pass restarts the step count within the same job
+                                for i in range(config['steps'] * 2):
+                                        job.step(i)
+                                job.finish()
+                        synchronize(device)
+                        results[mode] = {**counts, 'total_ms': (time.perf_counter() - start) * 1000}
+        finally:
+                prompt_parser.get_multicond_learned_conditioning = get_multicond_learned_conditioning
+                sega.SegaConceptStore.build = build
+        return {'cells': len(cells), **config, **results}
+
+
+def run_noise(sega, stubs, args) -> list:
+        """ Compare whole denoiser steps with SEGA off, in embedding space and in noise space """
+        device = torch.device(args.device)
+        sega.SEGA_MEMORY_BUDGET_MB = 0
+        sega.SEGA_SPARSE_DENSITY = 0
+        results = []
+        sweep = itertools.product(args.models, args.concepts, args.batch_sizes, args.tokens, args.dtypes)
+        for model, num_concepts, batch_size, tokens, dtype in sweep:
+                stubs['modules.shared'].sd_model = StubModel(model, getattr(torch, dtype), device)
+                config = {'model': model, 'num_concepts': num_concepts, 'batch_size': batch_size, 'tokens': tokens, 'dtype': dtype, 'latent_size': args.latent_size, 'unet_ms_per_row': args.unet_ms_per_row, 'steps': args.steps}
+                x = torch.randn((batch_size, 4, args.latent_size, args.latent_size), dtype=getattr(torch, dtype), device=device)
+                sigma = torch.ones((batch_size,), dtype=getattr(torch, dtype), device=device)
+                for mode in ['Off'] + sega.GUIDANCE_SPACES:
+                        sega_params = {'warmup': 0, 'active': mode != 'Off', 'guidance_space': mode}
+                        job = BenchmarkJob(sega, stubs, config, device, sega_params)
+                        denoiser = StubDenoiser(job.callbacks, job.p, unet_ms_per_row=args.unet_ms_per_row)
+                        job.start()
+                        for i in range(args.warmup):
+                                denoiser(x, sigma, i, config['steps'], job.text_cond, job.text_uncond)
+
+                        latencies = []
+                        for i in range(config['steps']):
+                                synchronize(device)
+                                start = time.perf_counter()
+                                denoiser(x, sigma, i, config['steps'], job.text_cond, job.text_uncond)
+                                synchronize(device)
+                                latencies.append(time.perf_counter() - start)
+                        job.finish()
+                        config[mode] = {**latency_stats(latencies), 'denoiser_rows': denoiser.rows}
+                results.append(config)
+                summary = ', '.join(f"{mode} {config[mode]['median_ms']:.3f} ms/step ({config[mode]['denoiser_rows']} rows)" for mode in ['Off'] + sega.GUIDANCE_SPACES)
+                print(f"{model} concepts={num_concepts} batch={batch_size} tokens={tokens} {dtype}: {summary}", file=sys.stderr)
+        return results
+
+
+def run_prefetch(sega, stubs, args) -> list:
+        """ Measure the denoiser callback at prompt-schedule segment boundaries with and without background prefetch """
+        device = torch.device(args.device)
+        sega.SEGA_MEMORY_BUDGET_MB = 0
+        sega.SEGA_SPARSE_DENSITY = 0
+        prefetch = sega.SEGA_PREFETCH
+        get = sega.SegaConceptStore.get
+        get_times = []
+
+        def timed_get(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                        return get(self, *args, **kwargs)
+                finally:
+                        get_times.append(time.perf_counter() - start)
+
+        sega.SegaConceptStore.get = timed_get
+        results = []
+        sweep = itertools.product(args.models, args.concepts, args.batch_sizes, args.tokens, args.dtypes)
+        try:
+                for model, num_concepts, batch_size, tokens, dtype in sweep:
+                        stubs['modules.shared'].sd_model = StubModel(model, getattr(torch, dtype), device)
+                        config = {'model': model, 'num_concepts': num_concepts, 'batch_size': batch_size, 'tokens': tokens, 'dtype': dtype, 'unet_ms_per_row': args.prefetch_unet_ms_per_row, 'steps': args.steps}
+                        # every concept switches prompts at a different step, so most steps start a new segment
+                        config['concept_prompts'] = [f'[concept {i}:other concept {i}:{1 + (i + 1) * (args.steps - 2) // (num_concepts + 1)}]' for i in range(num_concepts)]
+                        x = torch.randn((batch_size, 4, args.latent_size, args.latent_size), dtype=getattr(torch, dtype), device=device)
+                        sigma = torch.ones((batch_size,), dtype=getattr(torch, dtype), device=device)
+                        for mode in ('off', 'on'):
+                                sega.SEGA_PREFETCH = mode == 'on'
+                                sega.concept_store_cache.clear()
+                                job = BenchmarkJob(sega, stubs, config, device, {'warmup': 0})
+                                denoiser = StubDenoiser(job.callbacks, job.p, unet_ms_per_row=args.prefetch_unet_ms_per_row)
+                                job.start()
+                                boundaries = set(sega.sega_jobs.get(denoiser).concept_store.boundaries)
+
+                                latencies, callback_times, boundary_get_times = [], [], []
+                                for i in range(config['steps']):
+                                        get_times.clear()
+                                        synchronize(device)
+                                        start = time.perf_counter()
+                                        denoiser(x, sigma, i, config['steps'], job.text_cond, job.text_uncond)
+                                        synchronize(device)
+                                        latencies.append(time.perf_counter() - start)
+                                        callback_times.append(denoiser.callback_time)
+                                        # the first step after a boundary starts a new segment
+                                        if i - 1 in boundaries:
+                                                boundary_get_times.append(sum(get_times))
+                                job.finish()
+                                config[mode] = {
+                                        **latency_stats(latencies),
+                                        'callback_mean_ms': statistics.fmean(callback_times) * 1000,
+                                        'boundary_get_mean_ms': statistics.fmean(boundary_get_times) * 1000 if boundary_get_times else None,
+                                        'boundary_steps': len(boundary_get_times),
+                                }
+                        results.append(config)
+                        print(f"{model} concepts={num_concepts} batch={batch_size} tokens={tokens} {dtype}: concept tensors at segment boundaries {config['off']['boundary_get_mean_ms']:.3f} ms without prefetch, {config['on']['boundary_get_mean_ms']:.3f} ms with prefetch", file=sys.stderr)
+        finally:
+                sega.SEGA_PREFETCH = prefetch
+                sega.SegaConceptStore.get = get
+        return results
+
+
+def live_tensor_bytes() -> int:
+        """ Bytes of all tensor storages reachable by the garbage collector """
+        storages = {}
+        with warnings.catch_warnings():
+                # isinstance() on some lazily deprecated torch objects warns
+                warnings.simplefilter('ignore')
+                for obj in gc.get_objects():
+                        if isinstance(obj, torch.Tensor):
+                                try:
+                                        storage = obj.untyped_storage()
+                                        storages[storage.data_ptr()] = storage.nbytes()
+                                except RuntimeError:
+                                        # fake tensors left over from torch.compile tracing have no memory
+                                        pass
+        return sum(storages.values())
+
+
+def run_jobs(sega, stubs, args) -> dict:
+        """ Run many short jobs that complete, get interrupted or fail, and sample callbacks and live state """
+        device = torch.device(args.device)
+        callbacks = stubs['modules.script_callbacks']
+        stubs['modules.shared'].sd_model = StubModel('sd15', torch.float32, device)
+        config = {'model': 'sd15', 'num_concepts': 2, 'batch_size': 1, 'tokens': 77, 'dtype': 'float32', 'steps': 4}
+
+        samples = []
+        sample_every = max(args.jobs // 10, 1)
+        for i in range(args.jobs):
+                job = BenchmarkJob(sega, stubs, config, device)
+                job.start()
+                outcome = ('completed', 'interrupted', 'failed')[i % 3]
+                if outcome == 'completed':
+                        for step in range(config['steps']):
+                                job.step(step)
+                        job.finish()
+                elif outcome == 'interrupted':
+                        # the webui still runs postprocess_batch when sampling is interrupted
+                        job.step(0)
+                        job.finish()
+                else:
+                        # an exception skips postprocess_batch entirely
+                        try:
+                                job.step(0)
+                                raise RuntimeError('simulated sampling failure')
+                        except RuntimeError:
+                                pass
+                del job
+
+                if i == 0 or (i + 1) % sample_every == 0:
+                        gc.collect()
+                        samples.append({
+                                'jobs': i + 1,
+                                'callbacks': callbacks.callback_count(),
+                                'registered_jobs': len(sega.sega_jobs.jobs),
+                                'live_tensor_bytes': live_tensor_bytes(),
+                        })
+        return {'jobs': args.jobs, 'samples': samples}
+
+
+def main():
+        parser = argparse.ArgumentParser(description='Offline CPU benchmark for the Semantic Guidance denoiser callback')
+        parser.add_argument('--scenarios', nargs='+', default=['sweep'], choices=['sweep', 'jobs', 'sparse', 'thresholds', 'grid', 'noise', 'prefetch'])
+        parser.add_argument('--jobs', type=int, default=3000, help='number of jobs for the jobs scenario')
+        parser.add_argument('--models', nargs='+', default=['sd15', 'sdxl'], choices=list(MODEL_SHAPES.keys()))
+        parser.add_argument('--concepts', nargs='+', type=int, default=[1, 4, 8])
+        parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4])
+        parser.add_argument('--tokens', nargs='+', type=int, default=[77, 154])
+        parser.add_argument('--dtypes', nargs='+', default=['float32'], choices=['float32', 'float16', 'bfloat16'])
+        parser.add_argument('--memory-budgets', nargs='+', type=float, default=[0], help='SD_WEBUI_SEGA_MEMORY_BUDGET_MB values, 0 processes all concepts at once')
+        parser.add_argument('--grid-size', type=int, default=5, help='cells per axis of the grid scenario')
+        parser.add_argument('--latent-size', type=int, default=64, help='latent height and width of the noise scenario')
+        parser.add_argument('--unet-ms-per-row', type=float, default=0.0, help='simulated denoiser cost per batch row of the noise scenario')
+        parser.add_argument('--prefetch-unet-ms-per-row', type=float, default=10.0, help='simulated denoiser cost per batch row of the prefetch scenario')
+        parser.add_argument('--tail-thresholds', nargs='+', type=float, default=[0.001, 0.01, 0.05, 0.2], help='tail percentage thresholds for the sparse and thresholds scenarios')
+        parser.add_argument('--sparse-threshold-modes', nargs='+', default=['Exact', 'Approximate'], choices=['Exact', 'Approximate'], help='threshold modes of the sparse scenario, the Gaussian mode always uses dense guidance')
+        parser.add_argument('--steps', type=int, default=20, help='measured sampling steps per configuration')
+        parser.add_argument('--warmup', type=int, default=3, help='unmeasured steps before measuring')
+        parser.add_argument('--device', default='cpu')
+        parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+        parser.add_argument('--output', default=None, help='write JSON here instead of stdout')
+        args = parser.parse_args()
+
+        if args.threads is not None:
+                torch.set_num_threads(args.threads)
+        sega, stubs = load_sega()
+
+        report = {
+                'environment': {
+                        'torch': torch.__version__,
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'device': args.device,
+                        'threads': torch.get_num_threads(),
+                },
+        }
+
+        if 'sweep' in args.scenarios:
+                results = []
+                sweep = itertools.product(args.models, args.concepts, args.batch_sizes, args.tokens, args.dtypes, args.memory_budgets)
+                for model, num_concepts, batch_size, tokens, dtype, memory_budget_mb in sweep:
+                        config = {'model': model, 'num_concepts': num_concepts, 'batch_size': batch_size, 'tokens': tokens, 'dtype': dtype, 'memory_budget_mb': memory_budget_mb, 'steps': args.steps}
+                        result = run_config(sega, stubs, config, args)
+                        print(f"{model} concepts={num_concepts} batch={batch_size} tokens={tokens} {dtype} budget={memory_budget_mb}MB: {result['median_ms']:.3f} ms/step, peak {result['peak_bytes']} bytes", file=sys.stderr)
+                        results.append(result)
+                report['results'] = results
+
+        if 'jobs' in args.scenarios:
+                report['jobs'] = run_jobs(sega, stubs, args)
+                last = report['jobs']['samples'][-1]
+                print(f"jobs={last['jobs']} callbacks={last['callbacks']} registered_jobs={last['registered_jobs']} live_tensor_bytes={last['live_tensor_bytes']}", file=sys.stderr)
+
+        if 'sparse' in args.scenarios:
+                report['sparse'] = run_sparse(sega, stubs, args)
+
+        if 'thresholds' in args.scenarios:
+                report['thresholds'] = run_thresholds(sega, stubs, args)
+
+        if 'grid' in args.scenarios:
+                report['grid'] = run_grid(sega, stubs, args)
+                for mode in ('uncached', 'cached'):
+                        result = report['grid'][mode]
+                        print(f"grid {mode}: cells={report['grid']['cells']} encodings={result['encodings']} builds={result['builds']} total {result['total_ms']:.1f} ms", file=sys.stderr)
+
+        if 'noise' in args.scenarios:
+                report['noise'] = run_noise(sega, stubs, args)
+
+        if 'prefetch' in args.scenarios:
+                report['prefetch'] = run_prefetch(sega, stubs, args)
+        output = json.dumps(report, indent=2)
+        if args.output is None:
+                print(output)
+        else:
+                with open(args.output, 'w') as f:
+                        f.write(output)
+
+
+if __name__ == '__main__':
+        main()
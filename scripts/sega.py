@@ -1,11 +1,20 @@
 import logging
+import bisect
+import contextlib
+import functools
+import json
+import re
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from os import environ
 import modules.scripts as scripts
 import gradio as gr
 import scipy.stats as stats
 
 from modules import script_callbacks, prompt_parser
-from modules.script_callbacks import CFGDenoiserParams
+from modules.script_callbacks import CFGDenoiserParams, CFGDenoisedParams, AfterCFGCallbackParams
 from modules.prompt_parser import reconstruct_multicond_batch
 from modules.processing import StableDiffusionProcessing
 #from modules.shared import sd_model, opts
@@ -17,6 +26,45 @@ import torch
 logger = logging.getLogger(__name__)
 logger.setLevel(environ.get("SD_WEBUI_LOG_LEVEL", logging.INFO))
 
+# opt-in torch.compile of the guidance kernel, e.g. SD_WEBUI_SEGA_COMPILE=1
+SEGA_COMPILE = environ.get("SD_WEBUI_SEGA_COMPILE", "0").lower() in ("1", "true", "yes")
+
+# bounds for the concept conditioning cache shared across generations
+SEGA_CACHE_ENTRIES = int(environ.get("SD_WEBUI_SEGA_CACHE_ENTRIES", 64))
+SEGA_CACHE_MB = float(environ.get("SD_WEBUI_SEGA_CACHE_MB", 512))
+
+# memory budget for the guidance temporaries, concepts are processed in chunks that fit into it, 0 to process all concepts at once
+SEGA_MEMORY_BUDGET_MB = float(environ.get("SD_WEBUI_SEGA_MEMORY_BUDGET_MB", 0))
+
+# opt-in sparse guidance while at most this fraction of elements is above the tail threshold, 0 to always use dense guidance
+# off by default, the sparse benchmark found no density down to 0.001 where it beat dense guidance on cpu, since both compute
+# the full edit direction and the sparse path adds a device sync, a gather and a scatter
+SEGA_SPARSE_DENSITY = float(environ.get("SD_WEBUI_SEGA_SPARSE_DENSITY", 0))
+
+# opt-in building of the concept tensors of the next prompt-schedule segment in the background while the current step is denoised
+SEGA_PREFETCH = environ.get("SD_WEBUI_SEGA_PREFETCH", "0").lower() in ("1", "true", "yes")
+
+# tail threshold modes, Gaussian assumes normally distributed conditioning, Exact and Approximate select a percentile of |edit direction|
+THRESHOLD_MODES = ["Gaussian", "Exact", "Approximate"]
+
+# where guidance is applied, Embedding edits the text conditioning, Noise runs the concepts through the denoiser with cond and uncond
+GUIDANCE_SPACES = ["Embedding", "Noise"]
+
+# sample size and refresh interval in steps of the Approximate threshold mode
+SEGA_THRESHOLD_SAMPLES = int(environ.get("SD_WEBUI_SEGA_THRESHOLD_SAMPLES", 65536))
+SEGA_THRESHOLD_REFRESH = int(environ.get("SD_WEBUI_SEGA_THRESHOLD_REFRESH", 5))
+
+# opt-in profiling, SD_WEBUI_SEGA_PROFILE=1 logs per-generation aggregates as JSON, =infotext also adds them to the infotext
+SEGA_PROFILE = environ.get("SD_WEBUI_SEGA_PROFILE", "0").lower()
+SEGA_PROFILE_ENABLED = SEGA_PROFILE not in ("", "0", "false", "no")
+SEGA_PROFILE_INFOTEXT = SEGA_PROFILE == "infotext"
+
+def sega_range(name: str):
+        """ torch.profiler range around a stage of semantic guidance when profiling is enabled """
+        if not SEGA_PROFILE_ENABLED:
+                return contextlib.nullcontext()
+        return torch.profiler.record_function(f"sega::{name}")
+
 """
 
 An unofficial implementation of SEGA: Instructing Text-to-Image Models using Semantic Guidance for Automatic1111 WebUI
@@ -35,21 +83,631 @@ GitHub URL: https://github.com/v0xie/sd-webui-semantic-guidance
 
 """
 
+@functools.lru_cache(maxsize=None)
+def tail_z_score(tail_percentage_threshold: float) -> float:
+        """ z-score of the upper tail, cached per threshold value so scipy is not called on every step """
+        return float(stats.norm.ppf(1.0 - tail_percentage_threshold))
+
+def tail_rank(num_elements: int, tail_percentage_threshold: float) -> int:
+        """ 1-based rank of the largest value that is not selected, 0 if every value is selected """
+        return num_elements - round(tail_percentage_threshold * num_elements)
+
+def exact_tail_threshold(concept_cond, text_uncond, strength, tail_percentage_thresholds: list[float]):
+        """
+        Per-concept threshold that selects exactly the top tail_percentage_threshold fraction of |edit direction|
+        concept_cond: [num_concepts, batch_size, ...], text_uncond: [batch_size, ...], strength: [num_concepts, 1, ...]
+        kthvalue runs on one concept at a time, so only a single [batch_size, ...] temporary is allocated
+        """
+        thresholds = []
+        for i, tail_percentage_threshold in enumerate(tail_percentage_thresholds):
+                abs_dir = torch.sub(concept_cond[i], text_uncond).abs_().view(-1)
+                k = tail_rank(abs_dir.nelement(), tail_percentage_threshold)
+                thresholds.append(torch.kthvalue(abs_dir, k).values if k > 0 else abs_dir.new_tensor(-1.0))
+        return torch.stack(thresholds).view(strength.shape) * strength.abs()
+
+def approximate_tail_threshold(concept_cond, text_uncond, strength, tail_percentage_thresholds: list[float], sample_idx):
+        """
+        exact_tail_threshold estimated from the elements at sample_idx, the same sample for every concept
+        """
+        uncond_sample = torch.take(text_uncond, sample_idx)
+        abs_dir = torch.stack([torch.take(concept_cond[i], sample_idx) for i in range(concept_cond.shape[0])]).sub_(uncond_sample).abs_()
+        abs_dir = abs_dir.sort(dim=1).values
+        ranks = torch.tensor([tail_rank(abs_dir.shape[1], x) for x in tail_percentage_thresholds], device=abs_dir.device)
+        thresholds = abs_dir.gather(1, (ranks - 1).clamp_(min=0).unsqueeze(1)).squeeze(1)
+        thresholds = torch.where(ranks > 0, thresholds, -1.0)
+        return thresholds.view(strength.shape) * strength.abs()
+
+def sega_guidance_kernel(concept_cond, text_uncond, velocity, strength, upper_z, edit_guidance_scale, momentum_scale, momentum_beta, active=None, profile_stats=None, upper_threshold=None):
+        """
+        Fused semantic guidance for every concept of a single conditioning key
+        concept_cond: [num_concepts, batch_size, ...], text_uncond: [batch_size, ...]
+        Per-concept parameters and the optional boolean active mask are [num_concepts, 1, ...] tensors
+        velocity has the shape of concept_cond and is updated in-place
+        If a profile_stats dict is given, the number of elements above the tail threshold is accumulated into it without a device sync
+        upper_threshold overrides the Gaussian tail threshold from upper_z, see SegaConceptState.tail_threshold
+        Returns the momentum-adjusted edit direction summed over all concepts
+        """
+        with sega_range("statistics"):
+                # filter out values in-between tails
+                # FIXME: does this take into account image batch size?, i.e. dim 1
+                if upper_threshold is None:
+                        inside_dim = tuple(range(1, concept_cond.dim()))
+                        cond_std, cond_mean = torch.std_mean(concept_cond, dim=inside_dim, keepdim=True)
+                        upper_threshold = cond_mean + (upper_z * cond_std)
+
+        with sega_range("thresholding"):
+                # edit direction multiplied by strength for positive / negative direction
+                edit_dir = torch.sub(concept_cond, text_uncond).mul_(strength)
+
+                # the abs buffer is reused as the scale tensor: edit_guidance_scale where above the tail threshold, else 0
+                scale_tensor = edit_dir.abs().gt_(upper_threshold)
+                if profile_stats is not None:
+                        profile_stats['selected_elements'] = profile_stats.get('selected_elements', 0) + torch.count_nonzero(scale_tensor)
+                        profile_stats['total_elements'] = profile_stats.get('total_elements', 0) + scale_tensor.nelement()
+                scale_tensor.mul_(edit_guidance_scale)
+                edit_dir.mul_(scale_tensor)
+                del scale_tensor
+
+        with sega_range("momentum"):
+                # add momentum and calculate v_t+1 for all concepts at once
+                edit_dir.addcmul_(velocity, momentum_scale)
+                if active is None:
+                        velocity.mul_(1 - momentum_beta).mul_(momentum_beta).mul_(edit_dir)
+                else:
+                        # concepts outside of their warmup / cooldown window keep their velocity and add nothing
+                        velocity.copy_(torch.where(active, velocity * (1 - momentum_beta) * momentum_beta * edit_dir, velocity))
+                        edit_dir.mul_(active)
+                return edit_dir.sum(dim=0)
+
+# full-size temporaries per concept in sega_guidance_kernel: the edit direction and the scale tensor
+KERNEL_TEMPORARIES = 2
+
+def concept_chunk_size(concept_cond, memory_budget_mb: float = None, velocity: bool = True) -> int:
+        """
+        Number of concepts to process at once so the kernel temporaries of a chunk fit into the memory budget
+        With velocity, the budget also holds the dense velocity of every concept, which is kept across steps
+        """
+        if memory_budget_mb is None:
+                memory_budget_mb = SEGA_MEMORY_BUDGET_MB
+        num_concepts = concept_cond.shape[0]
+        if memory_budget_mb <= 0:
+                return num_concepts
+        concept_nbytes = concept_cond[0].nelement() * concept_cond.element_size()
+        budget_nbytes = int(memory_budget_mb * 1024 * 1024)
+        if velocity:
+                budget_nbytes -= num_concepts * concept_nbytes
+        return max(1, min(num_concepts, budget_nbytes // (concept_nbytes * KERNEL_TEMPORARIES)))
+
+def sega_sparse_guidance_kernel(concept_cond, text_uncond, strength, upper_z, edit_guidance_scale, active=None, profile_stats=None, upper_threshold=None):
+        """
+        Sparse variant of sega_guidance_kernel for low tail thresholds
+        Only the elements above the tail threshold are gathered
+        There is no momentum term, the velocity starts at zero and its update v * (1 - beta) * beta * edit_dir keeps it there
+        Returns the flat indices and values of the edit direction of all concepts, to be summed with index_add_
+        """
+        num_concepts = concept_cond.shape[0]
+        with sega_range("statistics"):
+                if upper_threshold is None:
+                        inside_dim = tuple(range(1, concept_cond.dim()))
+                        cond_std, cond_mean = torch.std_mean(concept_cond, dim=inside_dim, keepdim=True)
+                        upper_threshold = cond_mean + (upper_z * cond_std)
+
+        with sega_range("thresholding"):
+                edit_dir = torch.sub(concept_cond, text_uncond).mul_(strength)
+                mask = edit_dir.abs() > upper_threshold
+                if profile_stats is not None:
+                        profile_stats['selected_elements'] = profile_stats.get('selected_elements', 0) + torch.count_nonzero(mask)
+                        profile_stats['total_elements'] = profile_stats.get('total_elements', 0) + mask.nelement()
+                if active is not None:
+                        mask.logical_and_(active)
+                edit_dir = edit_dir.reshape(num_concepts, -1)
+                mask = mask.reshape(num_concepts, -1)
+                scale = edit_guidance_scale.reshape(-1)
+
+                # gather the selected elements, nonzero synchronizes with the device
+                concept_idx, flat_idx = mask.nonzero(as_tuple=True)
+                values = edit_dir[concept_idx, flat_idx] * scale[concept_idx]
+                return flat_idx, values
+
+def apply_sparse_edit(cond, shape, flat_idx, values):
+        """ cond + edit, where the edit of the given shape is only known at flat_idx, without modifying cond in-place """
+        if cond.shape == shape:
+                out = cond.clone(memory_format=torch.contiguous_format)
+                out.view(-1).index_add_(0, flat_idx, values.to(out.dtype))
+                return out
+        edit_dir = torch.zeros(shape, dtype=cond.dtype, device=cond.device)
+        edit_dir.view(-1).index_add_(0, flat_idx, values.to(edit_dir.dtype))
+        return cond + edit_dir
+
+_compiled_guidance_kernel = None
+
+def get_guidance_kernel():
+        """ Return the guidance kernel, compiled with torch.compile if SD_WEBUI_SEGA_COMPILE is set """
+        global _compiled_guidance_kernel
+        if not SEGA_COMPILE:
+                return sega_guidance_kernel
+        if _compiled_guidance_kernel is None:
+                try:
+                        _compiled_guidance_kernel = torch.compile(sega_guidance_kernel, dynamic=True)
+                except Exception:
+                        logger.exception("Semantic Guidance: torch.compile unavailable, using eager kernel")
+                        _compiled_guidance_kernel = sega_guidance_kernel
+        return _compiled_guidance_kernel
+
+def run_guidance_kernel(*args, **kwargs):
+        global SEGA_COMPILE
+        kernel = get_guidance_kernel()
+        if kernel is sega_guidance_kernel:
+                return kernel(*args, **kwargs)
+        try:
+                return kernel(*args, **kwargs)
+        except Exception:
+                # compilation happens lazily on the first call, fall back to eager for the rest of the session
+                logger.exception("Semantic Guidance: compiled kernel failed, falling back to eager kernel")
+                SEGA_COMPILE = False
+                return sega_guidance_kernel(*args, **kwargs)
+
+_prefetch_executor = None
+_prefetch_streams = {} # cuda device -> side stream of the prefetch worker
+
+def get_prefetch_executor() -> ThreadPoolExecutor:
+        global _prefetch_executor
+        if _prefetch_executor is None:
+                _prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sega_prefetch")
+        return _prefetch_executor
+
+def get_prefetch_stream(device: torch.device):
+        """ Side stream for prefetching on cuda devices, None elsewhere """
+        if device.type != 'cuda':
+                return None
+        if device not in _prefetch_streams:
+                _prefetch_streams[device] = torch.cuda.Stream(device)
+        return _prefetch_streams[device]
+
+def shutdown_prefetch():
+        global _prefetch_executor
+        if _prefetch_executor is not None:
+                _prefetch_executor.shutdown(wait=False, cancel_futures=True)
+                _prefetch_executor = None
+
+def conditioning_nbytes(cond) -> int:
+        """ Size in bytes of the tensors referenced by a MulticondLearnedConditioning, counting shared tensors once """
+        seen = set()
+        nbytes = 0
+        for composable_prompts in cond.batch:
+                for composable_prompt in composable_prompts:
+                        for schedule in composable_prompt.schedules:
+                                tensors = schedule.cond.values() if isinstance(schedule.cond, dict) else [schedule.cond]
+                                for tensor in tensors:
+                                        if id(tensor) not in seen:
+                                                seen.add(id(tensor))
+                                                nbytes += tensor.nelement() * tensor.element_size()
+        return nbytes
+
+class SegaConditioningCache:
+        """
+        Bounded LRU cache of concept conditionings shared across concepts and generations
+        Entries are evicted by count and by total tensor size, and the cache is cleared on checkpoint change
+        """
+        def __init__(self, max_entries: int, max_bytes: int):
+                self.max_entries = max_entries
+                self.max_bytes = max_bytes
+                self.entries = OrderedDict() # key -> (value, nbytes)
+                self.total_bytes = 0
+                self.hits = 0
+                self.misses = 0
+
+        def get(self, key):
+                entry = self.entries.get(key)
+                if entry is None:
+                        self.misses += 1
+                        return None
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        def put(self, key, value, nbytes: int):
+                if key in self.entries:
+                        self.total_bytes -= self.entries.pop(key)[1]
+                # never cache a single value larger than the whole budget
+                if self.max_entries <= 0 or nbytes > self.max_bytes:
+                        return
+                self.entries[key] = (value, nbytes)
+                self.total_bytes += nbytes
+                while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                        _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+                        self.total_bytes -= evicted_nbytes
+
+        def clear(self):
+                self.entries.clear()
+                self.total_bytes = 0
+
+        def stats(self) -> dict:
+                return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.total_bytes}
+
+concept_cond_cache = SegaConditioningCache(SEGA_CACHE_ENTRIES, int(SEGA_CACHE_MB * 1024 * 1024))
+
+# SegaConceptStore per tuple of concept cache keys, so generations with the same concepts reuse the padded concept tensors
+concept_store_cache = SegaConditioningCache(SEGA_CACHE_ENTRIES, int(SEGA_CACHE_MB * 1024 * 1024))
+
+class SegaProfiler:
+        """
+        Per-generation aggregates of the time and memory semantic guidance adds to sampling
+        Only collects anything when profiling is enabled with SD_WEBUI_SEGA_PROFILE
+        On CUDA, the device-wide peak memory stats are left alone for other tools, the peak is the largest allocation above the
+        allocation at callback entry sampled after every stage and chunk of semantic guidance, so temporaries freed within a
+        stage are not counted
+        """
+        def __init__(self, num_concepts: int, enabled: bool = SEGA_PROFILE_ENABLED):
+                self.enabled = enabled
+                self.num_concepts = num_concepts
+                self.steps = 0
+                self.active_steps = 0
+                self.total_time = 0.0
+                self.peak_allocated_bytes = None
+                self.max_active_concepts = 0
+                self.stats = {} if enabled else None
+                self.device = None # cuda device of the callback being measured
+                self.base_allocated = 0
+
+        @contextlib.contextmanager
+        def step(self, device: torch.device, count: bool = True):
+                """ Measure a single denoiser callback on the device of the latents, count=False adds the time of a later callback of the same step """
+                if not self.enabled:
+                        yield
+                        return
+                cuda = device.type == 'cuda'
+                if cuda:
+                        torch.cuda.synchronize(device)
+                        self.device = device
+                        self.base_allocated = torch.cuda.memory_allocated(device)
+                start = time.perf_counter()
+                try:
+                        with sega_range("step"):
+                                yield
+                finally:
+                        if cuda:
+                                torch.cuda.synchronize(device)
+                                self.sample()
+                                self.device = None
+                        self.total_time += time.perf_counter() - start
+                        if count:
+                                self.steps += 1
+
+        def sample(self):
+                """ Record the memory allocated above the callback entry, the allocator counts without a device sync """
+                if self.device is None:
+                        return
+                allocated = torch.cuda.memory_allocated(self.device) - self.base_allocated
+                self.peak_allocated_bytes = max(self.peak_allocated_bytes or 0, allocated)
+
+        def record_active(self, active_concepts: list[bool]):
+                if not self.enabled:
+                        return
+                num_active = sum(active_concepts)
+                if num_active > 0:
+                        self.active_steps += 1
+                self.max_active_concepts = max(self.max_active_concepts, num_active)
+
+        def report(self) -> dict:
+                selected_elements = self.stats.get('selected_elements', 0)
+                total_elements = self.stats.get('total_elements', 0)
+                return {
+                        'steps': self.steps,
+                        'active_steps': self.active_steps,
+                        'total_time_ms': round(self.total_time * 1000, 3),
+                        'time_per_step_ms': round(self.total_time * 1000 / max(self.steps, 1), 3),
+                        'peak_allocated_bytes': self.peak_allocated_bytes,
+                        'num_concepts': self.num_concepts,
+                        'active_concepts': self.max_active_concepts,
+                        'tail_fraction': round(float(selected_elements) / total_elements, 6) if total_elements > 0 else None,
+                }
+
 class SegaStateParams:
+        """ Guidance parameters of a single concept, packed into a SegaConceptState for sampling """
         def __init__(self):
                 self.concept_name = ''
-                self.v = {} # velocity
                 self.warmup_period: int = 10 # [0, 20]
+                self.cooldown_period: int = -1 # step at which to stop applying guidance, -1 to never stop
                 self.edit_guidance_scale: float = 1 # [0., 1.]
                 self.tail_percentage_threshold: float = 0.05 # [0., 1.] if abs value of difference between uncodition and concept-conditioned is less than this, then zero out the concept-conditioned values less than this
                 self.momentum_scale: float = 0.3 # [0., 1.]
                 self.momentum_beta: float = 0.6 # [0., 1.) # larger bm is less volatile changes in momentum
                 self.strength = 1.0
 
-class SegaExtensionScript(scripts.Script):
+        def is_active(self, sampling_step: int) -> bool:
+                """ Whether guidance is applied on this step, i.e. after warmup and before cooldown """
+                if sampling_step < self.warmup_period:
+                        return False
+                return self.cooldown_period < 0 or sampling_step < self.cooldown_period
+
+class SegaConceptState:
+        """
+        Struct-of-arrays guidance state for all concepts of a generation
+        Per-concept parameters are held as [num_concepts, 1, ...] device tensors so the per-concept math is a single broadcast op,
+        and the velocity is a single [num_concepts, ...] tensor per conditioning key
+        """
+        def __init__(self, sega_params: list[SegaStateParams], threshold_mode: str = "Gaussian"):
+                self.sega_params = sega_params
+                self.num_concepts = len(sega_params)
+                self.threshold_mode = threshold_mode
+                self.tail_percentage_thresholds = [x.tail_percentage_threshold for x in sega_params]
+                self.values = {
+                        'strength': [x.strength for x in sega_params],
+                        'edit_guidance_scale': [x.edit_guidance_scale for x in sega_params],
+                        'upper_z': [tail_z_score(x.tail_percentage_threshold) for x in sega_params], # z-scores for tails
+                        'momentum_scale': [x.momentum_scale for x in sega_params],
+                        'momentum_beta': [x.momentum_beta for x in sega_params],
+                }
+                self.device_params = {} # (dtype, device, dim) -> {name: [num_concepts, 1, ...] tensor}
+                self.velocity = {} # conditioning key -> [num_concepts, batch_size, ...] tensor
+                self.thresholds = {} # conditioning key -> (concept tensor, sampling step, [num_concepts, 1, ...] threshold tensor)
+                self.sample_idx = {} # (elements per concept, device) -> sampled flat indices for the Approximate threshold mode
+
+                # percentile thresholds select few elements at low tail thresholds, so start with sparse guidance and switch to dense if
+                # too many get selected, the Gaussian threshold selects far more than its tail percentage and always starts dense
+                max_threshold = max((x.tail_percentage_threshold for x in sega_params), default=1.0)
+                self.sparse = threshold_mode in ("Exact", "Approximate") and max_threshold <= SEGA_SPARSE_DENSITY
+
+        def active_concepts(self, sampling_step: int) -> list[bool]:
+                # evaluated on the host so steps outside every window are skipped without a device sync
+                return [x.is_active(sampling_step) for x in self.sega_params]
+
+        def tensors(self, like: torch.Tensor) -> dict:
+                """ Per-concept parameters as tensors broadcastable against [num_concepts, batch_size, ...] tensors like `like` """
+                cache_key = (like.dtype, like.device, like.dim())
+                if cache_key not in self.device_params:
+                        shape = (self.num_concepts,) + (1,) * (like.dim() - 1)
+                        self.device_params[cache_key] = {
+                                name: torch.tensor(values, dtype=like.dtype, device=like.device).view(shape)
+                                for name, values in self.values.items()
+                        }
+                return self.device_params[cache_key]
+
+        def active_mask(self, active_concepts: list[bool], like: torch.Tensor) -> torch.Tensor:
+                # built from the host-side step window, step counts would lose precision in a half precision dtype
+                shape = (self.num_concepts,) + (1,) * (like.dim() - 1)
+                return torch.tensor(active_concepts, dtype=torch.bool, device=like.device).view(shape)
+
+        def get_velocity(self, key: str, concept_cond: torch.Tensor) -> torch.Tensor:
+                # reinitialized if a scheduled concept prompt changed the token count
+                velocity = self.velocity.get(key)
+                if velocity is None or velocity.shape != concept_cond.shape or velocity.dtype != concept_cond.dtype:
+                        velocity = torch.zeros(concept_cond.shape, dtype=concept_cond.dtype, device=concept_cond.device)
+                        self.velocity[key] = velocity
+                return velocity
+
+        def tail_threshold(self, key: str, sampling_step: int, concept_cond: torch.Tensor, uncond: torch.Tensor):
+                """
+                Per-concept percentile threshold of |edit direction| for the Exact and Approximate modes, None for the Gaussian mode
+                Approximate thresholds are reused for SEGA_THRESHOLD_REFRESH steps while the concept tensor stays the same
+                """
+                if self.threshold_mode not in ("Exact", "Approximate"):
+                        return None
+                cached = self.thresholds.get(key)
+                if self.threshold_mode == "Approximate" and cached is not None and cached[0] is concept_cond and 0 <= sampling_step - cached[1] < SEGA_THRESHOLD_REFRESH:
+                        return cached[2]
+
+                strength = self.tensors(concept_cond)['strength']
+                num_elements = uncond.nelement()
+                if self.threshold_mode == "Exact" or num_elements <= SEGA_THRESHOLD_SAMPLES:
+                        threshold = exact_tail_threshold(concept_cond, uncond, strength, self.tail_percentage_thresholds)
+                else:
+                        sample_key = (num_elements, concept_cond.device)
+                        if sample_key not in self.sample_idx:
+                                # fixed seed, so the same sample is used on every refresh
+                                generator = torch.Generator().manual_seed(0)
+                                self.sample_idx[sample_key] = torch.randint(0, num_elements, (SEGA_THRESHOLD_SAMPLES,), generator=generator).to(concept_cond.device)
+                        threshold = approximate_tail_threshold(concept_cond, uncond, strength, self.tail_percentage_thresholds, self.sample_idx[sample_key])
+                self.thresholds[key] = (concept_cond, sampling_step, threshold)
+                return threshold
+
+class SegaConceptStore:
+        """
+        Padded concept tensors of a list of concepts
+        The stacked [num_concepts, batch_size, tokens, dim] tensors are built once per prompt-schedule segment and kept for every
+        segment, so hires-fix passes that restart the step count reuse them
+        Stores are shared across generations with the same concepts through concept_store_cache, i.e. XYZ grid cells that only
+        change numeric parameters
+        With SEGA_PREFETCH, the tensors of the next segment are built on a worker thread, and on a side stream on cuda, while the
+        current step is denoised
+        Each concept conditioning holds a single batch entry, which is broadcast across the image batch as a view
+        """
+        def __init__(self, concept_conds, concept_keys: tuple = None):
+                self.concept_conds = [concept_cond for concept_cond, *_ in concept_conds]
+                self.concept_keys = concept_keys # concept_cache_key of every concept, in order
+                # steps at which any scheduled concept prompt can switch to its next schedule, i.e. [a:b:0.5]
+                self.boundaries = sorted({
+                        schedule.end_at_step
+                        for concept_cond in self.concept_conds
+                        for composable_prompts in concept_cond.batch
+                        for composable_prompt in composable_prompts
+                        for schedule in composable_prompt.schedules
+                })
+                self.batch_tensors = {} # (segment, uncond shapes) -> {key: [num_concepts, batch_size, ...] tensor}
+                self.prefetches = {} # (segment, uncond shapes) -> Future of (batch tensor, cuda event or None)
+
+        def segment(self, sampling_step: int) -> int:
+                # reconstruct_multicond_batch picks the first schedule with sampling_step <= end_at_step,
+                # so every step between two boundaries resolves to the same schedules
+                return bisect.bisect_left(self.boundaries, sampling_step)
+
+        def cache_key(self, sampling_step: int, text_uncond: dict) -> tuple:
+                return (self.segment(sampling_step), tuple((key, tensor.shape[:2]) for key, tensor in text_uncond.items()))
+
+        def get(self, sampling_step: int, text_uncond: dict, total_sampling_steps: int = None, profiler: SegaProfiler = None) -> dict:
+                """ Return the cached stacked concept tensors for this step, building them on the first visit of a segment """
+                cache_key = self.cache_key(sampling_step, text_uncond)
+                batch_tensor = self.batch_tensors.get(cache_key)
+                if batch_tensor is None:
+                        batch_tensor = self.take_prefetch(cache_key)
+                        if batch_tensor is None:
+                                batch_tensor = self.build(sampling_step, text_uncond, profiler)
+                        self.batch_tensors[cache_key] = batch_tensor
+
+                # the uncond shapes rarely change between steps, so the next step most likely uses the same cache key
+                if SEGA_PREFETCH and total_sampling_steps is not None and sampling_step + 1 < total_sampling_steps and not shared.state.interrupted:
+                        self.prefetch(sampling_step + 1, text_uncond)
+                return batch_tensor
+
+        def prefetch(self, sampling_step: int, text_uncond: dict):
+                """ Start building the concept tensors of a step on the prefetch worker, unless they are built or pending """
+                cache_key = self.cache_key(sampling_step, text_uncond)
+                if cache_key in self.batch_tensors or cache_key in self.prefetches:
+                        return
+                device = next(iter(text_uncond.values())).device
+                stream = get_prefetch_stream(device)
+                ready = None
+                if stream is not None:
+                        # recorded here, the worker thread has a different current stream
+                        ready = torch.cuda.Event()
+                        ready.record(torch.cuda.current_stream(device))
+                self.prefetches[cache_key] = get_prefetch_executor().submit(self.build_on_stream, sampling_step, text_uncond, stream, ready)
+
+        def build_on_stream(self, sampling_step: int, text_uncond: dict, stream, ready=None):
+                if stream is None:
+                        return self.build(sampling_step, text_uncond), None
+                with torch.cuda.stream(stream):
+                        # order the build after the work queued on the current stream so far, i.e. encoding the concepts
+                        stream.wait_event(ready)
+                        batch_tensor = self.build(sampling_step, text_uncond)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                return batch_tensor, event
+
+        def take_prefetch(self, cache_key: tuple) -> dict:
+                """ Wait for a pending prefetch, None if there is none or it failed """
+                future = self.prefetches.pop(cache_key, None)
+                if future is None:
+                        return None
+                try:
+                        with sega_range("prefetch_wait"):
+                                batch_tensor, event = future.result()
+                except CancelledError:
+                        return None
+                except Exception:
+                        logger.exception("Semantic Guidance: prefetch failed, building concept tensors in the denoiser callback")
+                        return None
+
+                # order the side stream work before the current stream and keep the memory alive until the current stream is done with it
+                if event is not None:
+                        current_stream = torch.cuda.current_stream(next(iter(batch_tensor.values())).device)
+                        current_stream.wait_event(event)
+                        for tensor in batch_tensor.values():
+                                tensor.record_stream(current_stream)
+                return batch_tensor
+
+        def cancel_prefetch(self):
+                """ Cancel pending prefetches, a build that already started finishes in the background and is dropped """
+                for future in self.prefetches.values():
+                        future.cancel()
+                self.prefetches.clear()
+
+        def nbytes(self) -> int:
+                """ Size in bytes of the built concept tensors, counting storages shared between segments once """
+                storages = {}
+                for batch_tensor in self.batch_tensors.values():
+                        for tensor in batch_tensor.values():
+                                storage = tensor.untyped_storage()
+                                storages[storage.data_ptr()] = storage.nbytes()
+                return sum(storages.values())
+
+        def build(self, sampling_step: int, text_uncond: dict, profiler: SegaProfiler = None) -> dict:
+                batch_tensors = {}
+                for concept_cond in self.concept_conds:
+                        with sega_range("reconstruction"):
+                                _, tensor_dict = reconstruct_multicond_batch(concept_cond, sampling_step)
+
+                        # sd 1.5 support
+                        if isinstance(tensor_dict, torch.Tensor):
+                                tensor_dict = {'crossattn': tensor_dict}
+
+                        with sega_range("padding"):
+                                for key, tensor in tensor_dict.items():
+                                        if tensor.shape[1] != text_uncond[key].shape[1]:
+                                                empty = shared.sd_model.cond_stage_model_empty_prompt
+                                                num_repeats = (tensor.shape[1] - text_uncond[key].shape[1]) // empty.shape[1]
+                                                if num_repeats < 0:
+                                                        tensor = pad_cond(tensor, -num_repeats, empty)
+                                        batch_tensors.setdefault(key, []).append(tensor)
+                        if profiler is not None:
+                                profiler.sample()
+
+                # [num_concepts, 1, ...] expanded to [num_concepts, batch_size, ...] without copying
+                # the stacked tensors are shared across steps and must not be modified in-place
+                batch_tensor = {}
+                for key, tensors in batch_tensors.items():
+                        stacked = torch.stack(tensors, dim=0)
+                        batch_size = text_uncond[key].shape[0]
+                        batch_tensor[key] = stacked.expand((-1, batch_size) + tuple(stacked.shape[2:]))
+                        if profiler is not None:
+                                profiler.sample()
+                return batch_tensor
+
+class SegaJob:
+        """ Semantic guidance state of a single job, released as soon as the job completes, is interrupted or fails """
+        def __init__(self, script, concept_store: SegaConceptStore, concept_state: SegaConceptState, profiler: SegaProfiler, guidance_space: str = "Embedding"):
+                self.script = script
+                self.concept_store = concept_store
+                self.concept_state = concept_state
+                self.profiler = profiler
+                self.guidance_space = guidance_space
+                # noise space guidance of the current step, passed from the denoiser callback to the post-cfg callback
+                self.noise_rows = None # (first concept row, num_concepts, batch_size) in the batch sent through the denoiser
+                self.noise_edit = None # [batch_size, ...] edit direction added to the combined prediction
+                self.noise_layout_warned = False
+
+class SegaJobRegistry:
+        """
+        Job-scoped semantic guidance state, looked up by the denoiser callbacks that are registered once at load
+        The webui samples one job at a time, so registering a job also releases anything left behind by an interrupted or failed one
+        """
         def __init__(self):
-                self.cached_c = [None, None]
+                self.jobs = {} # id(p) -> SegaJob
+                self.finalizers = {} # id(p) -> weakref.finalize of p
+
+        def register(self, p, job: SegaJob):
+                self.release_all()
+                key = id(p)
+                self.jobs[key] = job
+                # release the state once the processing object is garbage collected, i.e. after an exception skipped postprocess_batch
+                # process_batch runs for every batch of the same p, so it is only watched once
+                if key in self.finalizers:
+                        return
+                try:
+                        self.finalizers[key] = weakref.finalize(p, self.finalize_key, key)
+                except TypeError:
+                        pass
+
+        def get(self, params) -> SegaJob:
+                p = getattr(getattr(params, 'denoiser', None), 'p', None)
+                if p is not None:
+                        return self.jobs.get(id(p))
+                # the webui didn't pass the denoiser, fall back to the only job being sampled
+                if len(self.jobs) == 1:
+                        return next(iter(self.jobs.values()))
+                return None
+
+        def release(self, p) -> SegaJob:
+                return self.release_key(id(p))
+
+        def release_key(self, key: int) -> SegaJob:
+                job = self.jobs.pop(key, None)
+                if job is not None:
+                        job.concept_store.cancel_prefetch()
+                return job
+
+        def finalize_key(self, key: int):
+                self.finalizers.pop(key, None)
+                self.release_key(key)
 
+        def release_all(self):
+                for key in list(self.jobs.keys()):
+                        self.release_key(key)
+
+sega_jobs = SegaJobRegistry()
+
+class SegaExtensionScript(scripts.Script):
         # Extension title in menu UI
         def title(self):
                 return "Semantic Guidance"
@@ -68,51 +726,67 @@ class SegaExtensionScript(scripts.Script):
                                 neg_prompt = gr.Textbox(lines=2, label="Negative Prompt", elem_id = 'sega_neg_prompt', elem_classes=["prompt"])
                         with gr.Row():
                                 warmup = gr.Slider(value = 10, minimum = 0, maximum = 30, step = 1, label="Warmup Period", elem_id = 'sega_warmup', info="How many steps to wait before applying semantic guidance, default 10")
+                                cooldown = gr.Slider(value = -1, minimum = -1, maximum = 150, step = 1, label="Cooldown / Stop At Step", elem_id = 'sega_cooldown', info="Step at which to stop applying semantic guidance, -1 to never stop, default -1")
                                 edit_guidance_scale = gr.Slider(value = 1.0, minimum = 0.0, maximum = 20.0, step = 0.01, label="Edit Guidance Scale", elem_id = 'sega_edit_guidance_scale', info="Scale of edit guidance, default 1.0")
                                 tail_percentage_threshold = gr.Slider(value = 0.05, minimum = 0.0, maximum = 1.0, step = 0.01, label="Tail Percentage Threshold", elem_id = 'sega_tail_percentage_threshold', info="The percentage of latents to modify, default 0.05")
+                                threshold_mode = gr.Radio(value = "Gaussian", choices = THRESHOLD_MODES, label="Threshold Mode", elem_id = 'sega_threshold_mode', info="How the tail threshold is computed, Gaussian assumes normally distributed conditioning, Exact and Approximate select a percentile, default Gaussian")
                                 momentum_scale = gr.Slider(value = 0.3, minimum = 0.0, maximum = 1.0, step = 0.01, label="Momentum Scale", elem_id = 'sega_momentum_scale', info="Scale of momentum, default 0.3")
                                 momentum_beta = gr.Slider(value = 0.6, minimum = 0.0, maximum = 0.999, step = 0.01, label="Momentum Beta", elem_id = 'sega_momentum_beta', info="Beta for momentum, default 0.6")
+                                guidance_space = gr.Radio(value = "Embedding", choices = GUIDANCE_SPACES, label="Guidance Space", elem_id = 'sega_guidance_space', info="Embedding edits the text conditioning, Noise batches the concepts into the denoiser pass and edits its prediction, default Embedding")
                 active.do_not_save_to_config = True
                 prompt.do_not_save_to_config = True
                 neg_prompt.do_not_save_to_config = True
                 warmup.do_not_save_to_config = True
+                cooldown.do_not_save_to_config = True
                 edit_guidance_scale.do_not_save_to_config = True
                 tail_percentage_threshold.do_not_save_to_config = True
+                threshold_mode.do_not_save_to_config = True
                 momentum_scale.do_not_save_to_config = True
                 momentum_beta.do_not_save_to_config = True
+                guidance_space.do_not_save_to_config = True
                 self.infotext_fields = [
                         (active, lambda d: gr.Checkbox.update(value='SEGA Active' in d)),
                         (prompt, 'SEGA Prompt'),
                         (neg_prompt, 'SEGA Negative Prompt'),
                         (warmup, 'SEGA Warmup Period'),
+                        (cooldown, 'SEGA Cooldown Step'),
                         (edit_guidance_scale, 'SEGA Edit Guidance Scale'),
                         (tail_percentage_threshold, 'SEGA Tail Percentage Threshold'),
+                        (threshold_mode, 'SEGA Threshold Mode'),
                         (momentum_scale, 'SEGA Momentum Scale'),
                         (momentum_beta, 'SEGA Momentum Beta'),
+                        (guidance_space, 'SEGA Guidance Space'),
                 ]
                 self.paste_field_names = [
                         'sega_active',
                         'sega_prompt',
                         'sega_neg_prompt',
                         'sega_warmup',
+                        'sega_cooldown',
                         'sega_edit_guidance_scale',
                         'sega_tail_percentage_threshold',
+                        'sega_threshold_mode',
                         'sega_momentum_scale',
-                        'sega_momentum_beta'
+                        'sega_momentum_beta',
+                        'sega_guidance_space',
                 ]
-                return [active, prompt, neg_prompt, warmup, edit_guidance_scale, tail_percentage_threshold, momentum_scale, momentum_beta]
+                # controls added after the first release go at the end, so positional process_batch callers keep working
+                return [active, prompt, neg_prompt, warmup, edit_guidance_scale, tail_percentage_threshold, momentum_scale, momentum_beta, cooldown, threshold_mode, guidance_space]
 
-        def process_batch(self, p: StableDiffusionProcessing, active, prompt, neg_prompt, warmup, edit_guidance_scale, tail_percentage_threshold, momentum_scale, momentum_beta, *args, **kwargs):
+        def process_batch(self, p: StableDiffusionProcessing, active, prompt, neg_prompt, warmup, edit_guidance_scale, tail_percentage_threshold, momentum_scale, momentum_beta, cooldown=-1, threshold_mode="Gaussian", guidance_space="Embedding", *args, **kwargs):
                 active = getattr(p, "sega_active", active)
                 if active is False:
                         return
                 prompt = getattr(p, "sega_prompt", prompt)
                 neg_prompt = getattr(p, "sega_neg_prompt", neg_prompt)
                 warmup = getattr(p, "sega_warmup", warmup)
+                cooldown = getattr(p, "sega_cooldown", cooldown)
                 edit_guidance_scale = getattr(p, "sega_edit_guidance_scale", edit_guidance_scale)
                 tail_percentage_threshold = getattr(p, "sega_tail_percentage_threshold", tail_percentage_threshold)
+                threshold_mode = getattr(p, "sega_threshold_mode", threshold_mode)
                 momentum_scale = getattr(p, "sega_momentum_scale", momentum_scale)
                 momentum_beta = getattr(p, "sega_momentum_beta", momentum_beta)
+                guidance_space = getattr(p, "sega_guidance_space", guidance_space)
                 # FIXME: must have some prompt
                 #if prompt is None:
                 #        return
@@ -124,33 +798,63 @@ class SegaExtensionScript(scripts.Script):
                         "SEGA Prompt": prompt,
                         "SEGA Negative Prompt": neg_prompt,
                         "SEGA Warmup Period": warmup,
+                        "SEGA Cooldown Step": cooldown,
                         "SEGA Edit Guidance Scale": edit_guidance_scale,
                         "SEGA Tail Percentage Threshold": tail_percentage_threshold,
+                        "SEGA Threshold Mode": threshold_mode,
                         "SEGA Momentum Scale": momentum_scale,
                         "SEGA Momentum Beta": momentum_beta,
+                        "SEGA Guidance Space": guidance_space,
                 }
 
                 # separate concepts by comma
-                concept_prompts = self.parse_concept_prompt(prompt)
-                concept_prompts_neg = self.parse_concept_prompt(neg_prompt)
-                # [[concept_1,  strength_1], ...]
-                concept_prompts = [prompt_parser.parse_prompt_attention(concept)[0] for concept in concept_prompts]
-                concept_prompts_neg = [prompt_parser.parse_prompt_attention(neg_concept)[0] for neg_concept in concept_prompts_neg]
-                concept_prompts_neg = [[concept, -strength] for concept, strength in concept_prompts_neg]
-                concept_prompts.extend(concept_prompts_neg)
-
-                concept_conds = []
-                for concept, strength in concept_prompts:
-                        prompt_list = [concept] * p.batch_size
-                        prompts = prompt_parser.SdConditioning(prompt_list, width=p.width, height=p.height)
-                        c = p.get_conds_with_caching(prompt_parser.get_multicond_learned_conditioning, prompts, p.steps, [self.cached_c], p.extra_network_data)
-                        concept_conds.append([c, strength])
-
-                self.create_hook(p, active, concept_conds, None, warmup, edit_guidance_scale, tail_percentage_threshold, momentum_scale, momentum_beta)
+                concept_prompts = [[concept, 1.0] for concept in self.parse_concept_prompt(prompt)]
+                concept_prompts.extend([[neg_concept, -1.0] for neg_concept in self.parse_concept_prompt(neg_prompt)])
+                # [[concept_1,  strength_1, params_1], ...]
+                concepts = []
+                for concept_prompt, sign in concept_prompts:
+                        concept_prompt, concept_params = self.parse_concept_params(concept_prompt)
+                        concept, strength = prompt_parser.parse_prompt_attention(concept_prompt)[0]
+                        concepts.append([concept, sign * strength, concept_params])
+
+                # encode every unique concept that isn't cached yet, positive and negative together, in a single batched call
+                # each concept is encoded once and broadcast across the image batch by SegaConceptStore
+                concept_keys = {concept: self.concept_cache_key(p, concept) for concept, *_ in concepts}
+                cached_conds = {concept: concept_cond_cache.get(cache_key) for concept, cache_key in concept_keys.items()}
+                missing_concepts = [concept for concept, c in cached_conds.items() if c is None]
+                if len(missing_concepts) > 0:
+                        prompts = prompt_parser.SdConditioning(missing_concepts, width=p.width, height=p.height)
+                        # a fresh cache slot so get_conds_with_caching always encodes, caching is handled by concept_cond_cache
+                        c = p.get_conds_with_caching(prompt_parser.get_multicond_learned_conditioning, prompts, p.steps, [[None, None]], p.extra_network_data)
+                        for i, concept in enumerate(missing_concepts):
+                                concept_c = prompt_parser.MulticondLearnedConditioning(shape=(1,), batch=[c.batch[i]])
+                                concept_cond_cache.put(concept_keys[concept], concept_c, conditioning_nbytes(concept_c))
+                                cached_conds[concept] = concept_c
+                concept_conds = [[cached_conds[concept], strength, {'concept_name': concept, **concept_params}] for concept, strength, concept_params in concepts]
+                logger.debug('Concept conditioning cache: %s', concept_cond_cache.stats())
+
+                concept_keys = tuple(concept_keys[concept] for concept, *_ in concepts)
+                self.create_hook(p, active, concept_conds, None, warmup, cooldown, edit_guidance_scale, tail_percentage_threshold, threshold_mode, momentum_scale, momentum_beta, guidance_space, concept_keys=concept_keys)
+
+        def concept_cache_key(self, p: StableDiffusionProcessing, concept: str) -> tuple:
+                """ Everything the encoded concept conditioning depends on """
+                extra_network_data = tuple(sorted(
+                        (name, tuple(tuple(getattr(param, 'items', [])) for param in extra_network_params))
+                        for name, extra_network_params in (p.extra_network_data or {}).items()
+                ))
+                return (
+                        concept,
+                        p.steps,
+                        p.width,
+                        p.height,
+                        getattr(shared.sd_model, 'sd_model_hash', None),
+                        getattr(shared.opts, 'CLIP_stop_at_last_layers', None),
+                        extra_network_data,
+                )
 
         def parse_concept_prompt(self, prompt:str) -> list[str]:
                 """
-                Separate prompt by comma into a list of concepts
+                Separate prompt by comma into a list of concepts, ignoring commas inside of (), [] and {}
                 TODO: parse prompt into a list of concepts using A1111 functions
                 >>> g = lambda prompt: self.parse_concept_prompt(prompt)
                 >>> g("")
@@ -159,44 +863,233 @@ class SegaExtensionScript(scripts.Script):
                 ['apples']
                 >>> g("apple, banana, carrot")
                 ['apple', 'banana', 'carrot']
+                >>> g("apple {scale=2, warmup=5}, banana")
+                ['apple {scale=2, warmup=5}', 'banana']
                 """
                 if len(prompt) == 0:
                         return []
-                return [x.strip() for x in prompt.split(",")]
+                concepts = []
+                depth = 0
+                start = 0
+                escaped = False
+                for i, char in enumerate(prompt):
+                        if escaped:
+                                escaped = False
+                        elif char == '\\':
+                                escaped = True
+                        elif char in '([{':
+                                depth += 1
+                        elif char in ')]}':
+                                depth = max(depth - 1, 0)
+                        elif char == ',' and depth == 0:
+                                concepts.append(prompt[start:i].strip())
+                                start = i + 1
+                concepts.append(prompt[start:].strip())
+                return concepts
+
+        # per-concept parameter name -> (SegaStateParams attribute, type)
+        concept_param_names = {
+                'warmup': ('warmup_period', lambda x: int(float(x))),
+                'cooldown': ('cooldown_period', lambda x: int(float(x))),
+                'scale': ('edit_guidance_scale', float),
+                'threshold': ('tail_percentage_threshold', float),
+                'momentum': ('momentum_scale', float),
+                'beta': ('momentum_beta', float),
+        }
+
+        def parse_concept_params(self, concept: str) -> tuple[str, dict]:
+                """
+                Split trailing per-concept guidance parameters from a concept, i.e. "concept {scale=2, warmup=5}"
+                Supported parameters: warmup, cooldown, scale, threshold, momentum, beta
+                >>> g = lambda concept: self.parse_concept_params(concept)
+                >>> g("apples")
+                ('apples', {})
+                >>> g("(apples:1.2) {scale=2, warmup=5}")
+                ('(apples:1.2)', {'edit_guidance_scale': 2.0, 'warmup_period': 5})
+                """
+                match = re.fullmatch(r'(.*?)\s*\{([^{}]*)\}\s*', concept, flags=re.DOTALL)
+                if match is None:
+                        return concept, {}
+                concept, param_str = match.groups()
+                concept_params = {}
+                for param in param_str.split(','):
+                        name, _, value = param.partition('=')
+                        name = name.strip().lower()
+                        if len(name) == 0:
+                                continue
+                        if name not in self.concept_param_names:
+                                logger.warning(f"Semantic Guidance: ignoring unknown parameter '{name}' for concept '{concept}'")
+                                continue
+                        attr, cast = self.concept_param_names[name]
+                        try:
+                                concept_params[attr] = cast(value.strip())
+                        except ValueError:
+                                logger.warning(f"Semantic Guidance: ignoring invalid value '{value.strip()}' for parameter '{name}' of concept '{concept}'")
+                return concept, concept_params
 
-        def create_hook(self, p, active, concept_conds, concept_conds_neg, warmup, edit_guidance_scale, tail_percentage_threshold, momentum_scale, momentum_beta, *args, **kwargs):
-                # Create a list of parameters for each concept
+        def create_hook(self, p, active, concept_conds, concept_conds_neg, warmup, cooldown, edit_guidance_scale, tail_percentage_threshold, threshold_mode, momentum_scale, momentum_beta, guidance_space, *args, concept_keys: tuple = None, **kwargs):
+                # Create a list of parameters for each concept, per-concept parameters from the prompt override the global ones
                 concepts_sega_params = []
-                for _, strength in concept_conds:
+                for _, strength, concept_params in concept_conds:
                         sega_params = SegaStateParams()
                         sega_params.warmup_period = warmup
+                        sega_params.cooldown_period = cooldown
                         sega_params.edit_guidance_scale = edit_guidance_scale
                         sega_params.tail_percentage_threshold = tail_percentage_threshold
                         sega_params.momentum_scale = momentum_scale
                         sega_params.momentum_beta = momentum_beta
                         sega_params.strength = strength
+                        for attr, value in concept_params.items():
+                                setattr(sega_params, attr, value)
                         concepts_sega_params.append(sega_params)
 
-                # Use lambda to call the callback function with the parameters to avoid global variables
-                y = lambda params: self.on_cfg_denoiser_callback(params, concept_conds, concepts_sega_params)
+                # only the numeric parameters changed since a previous generation with these concepts, e.g. between XYZ grid cells
+                concept_store = concept_store_cache.get(concept_keys) if concept_keys is not None else None
+                if concept_store is None:
+                        concept_store = SegaConceptStore(concept_conds, concept_keys)
+                concept_state = SegaConceptState(concepts_sega_params, threshold_mode)
+                profiler = SegaProfiler(len(concepts_sega_params))
 
-                logger.debug('Hooked callbacks')
-                script_callbacks.on_cfg_denoiser(y)
-                script_callbacks.on_script_unloaded(self.unhook_callbacks)
+                # the denoiser callback is registered once at load and dispatches to the state of the job being sampled
+                logger.debug('Registered job')
+                sega_jobs.register(p, SegaJob(self, concept_store, concept_state, profiler, guidance_space))
 
         def postprocess_batch(self, p, active, neg_text, *args, **kwargs):
-                active = getattr(p, "sega_active", active)
-                if active is False:
+                job = sega_jobs.release(p)
+                if job is None:
                         return
-                self.unhook_callbacks()
+                logger.debug('Released job')
+
+                # cached once the concept tensors of the job are built and their size is known
+                concept_store = job.concept_store
+                if concept_store.concept_keys is not None:
+                        concept_store_cache.put(concept_store.concept_keys, concept_store, concept_store.nbytes())
+                        logger.debug('Concept store cache: %s', concept_store_cache.stats())
 
-        def unhook_callbacks(self):
-                logger.debug('Unhooked callbacks')
-                script_callbacks.remove_current_script_callbacks()
+                profiler = job.profiler
+                if profiler.enabled:
+                        report = profiler.report()
+                        logger.info('Semantic Guidance profile: %s', json.dumps(report))
+                        if SEGA_PROFILE_INFOTEXT:
+                                p.extra_generation_params["SEGA Profile"] = json.dumps(report, separators=(',', ':'))
 
-        def on_cfg_denoiser_callback(self, params: CFGDenoiserParams, concept_conds, sega_params: list[SegaStateParams]):
+        def on_cfg_denoiser_noise_callback(self, params: CFGDenoiserParams, job: SegaJob):
+                with job.profiler.step(params.x.device):
+                        self.sega_noise_denoiser_step(params, job)
+
+        def on_cfg_denoised_noise_callback(self, params: CFGDenoisedParams, job: SegaJob):
+                if job.noise_rows is None:
+                        return
+                with job.profiler.step(params.x.device, count=False):
+                        self.sega_noise_denoised_step(params, job)
+
+        def on_cfg_after_cfg_noise_callback(self, params: AfterCFGCallbackParams, job: SegaJob):
+                if job.noise_edit is None:
+                        return
+                with job.profiler.step(params.x.device, count=False):
+                        params.x = params.x + job.noise_edit
+                job.noise_edit = None
+
+        def sega_noise_denoiser_step(self, params: CFGDenoiserParams, job: SegaJob):
+                """
+                Append a row per concept and image to the batch sent through the denoiser, between the cond and uncond rows
+                The webui takes cond rows from the front and uncond rows from the back of the denoiser output, so the concept rows
+                are skipped by its cfg and only read by sega_noise_denoised_step
+                """
+                job.noise_rows = None
+                job.noise_edit = None
+                sampling_step = params.sampling_step
+                concept_state = job.concept_state
+                active_concepts = concept_state.active_concepts(sampling_step)
+                job.profiler.record_active(active_concepts)
+                if not any(active_concepts):
+                        return
+
+                # sd 1.5 support
+                text_cond = params.text_cond if isinstance(params.text_cond, dict) else {'crossattn': params.text_cond}
+                text_uncond = params.text_uncond if isinstance(params.text_uncond, dict) else {'crossattn': params.text_uncond}
+                batch_size = text_uncond['crossattn'].shape[0]
+                num_concepts = concept_state.num_concepts
+
+                # the latent batch must be the cond rows followed by a single block of uncond rows, edit models such as
+                # instruct-pix2pix append another block of rows per image
+                cond_rows = text_cond['crossattn'].shape[0]
+                if params.x.shape[0] != cond_rows + batch_size:
+                        if not job.noise_layout_warned:
+                                logger.warning("Semantic Guidance: noise space guidance does not support a denoiser batch of %d rows for %d cond and %d uncond rows, skipping", params.x.shape[0], cond_rows, batch_size)
+                                job.noise_layout_warned = True
+                        return
+
+                # the webui skips the uncond pass on every other step below s_min_uncond, except for edit models which are skipped
+                # above, and passes a copy of the cond prediction as the uncond prediction, so there is nothing to guide against
+                s_min_uncond = getattr(shared.opts, 's_min_uncond', 0)
+                if s_min_uncond > 0 and getattr(params.denoiser, 'step', 0) % 2 and params.sigma[0] < s_min_uncond:
+                        return
+
+                # concept tensors are padded to the uncond length, the cond rows they are appended to can still differ in length
+                batch_tensor = job.concept_store.get(sampling_step, text_uncond, params.total_sampling_steps, job.profiler)
+                with sega_range("padding"):
+                        for key, concept_cond in batch_tensor.items():
+                                cond = text_cond[key]
+                                concept_rows = concept_cond.reshape((-1,) + tuple(concept_cond.shape[2:]))
+                                if concept_rows.dim() == 3 and concept_rows.shape[1] != cond.shape[1]:
+                                        empty = shared.sd_model.cond_stage_model_empty_prompt
+                                        num_repeats = (concept_rows.shape[1] - cond.shape[1]) // empty.shape[1]
+                                        if num_repeats < 0:
+                                                concept_rows = pad_cond(concept_rows, -num_repeats, empty)
+                                        elif num_repeats > 0:
+                                                cond = pad_cond(cond, num_repeats, empty)
+                                text_cond[key] = torch.cat([cond, concept_rows])
+                if not isinstance(params.text_cond, dict):
+                        params.text_cond = text_cond['crossattn']
+
+                # every concept row is denoised from the latent of its image, the same as the uncond rows at the back of the batch
+                def insert_concept_rows(tensor):
+                        if not isinstance(tensor, torch.Tensor):
+                                return tensor
+                        uncond_rows = tensor[-batch_size:]
+                        return torch.cat([tensor[:-batch_size], uncond_rows.repeat((num_concepts,) + (1,) * (tensor.dim() - 1)), uncond_rows])
+
+                params.x = insert_concept_rows(params.x)
+                params.sigma = insert_concept_rows(params.sigma)
+                params.image_cond = insert_concept_rows(params.image_cond)
+                job.noise_rows = (params.x.shape[0] - (num_concepts + 1) * batch_size, num_concepts, batch_size)
+
+        def sega_noise_denoised_step(self, params: CFGDenoisedParams, job: SegaJob):
+                start, num_concepts, batch_size = job.noise_rows
+                job.noise_rows = None
+                x_out = params.x
+                # the batch no longer holds the rows inserted by sega_noise_denoiser_step, e.g. another extension changed it
+                if x_out.shape[0] != start + (num_concepts + 1) * batch_size:
+                        return
+
+                sampling_step = params.sampling_step
+                concept_state = job.concept_state
+                concept_out = x_out[start:start + num_concepts * batch_size].view((num_concepts, batch_size) + tuple(x_out.shape[1:]))
+                uncond_out = x_out[-batch_size:]
+                active_concepts = concept_state.active_concepts(sampling_step)
+                active = None if all(active_concepts) else concept_state.active_mask(active_concepts, concept_out)
+                with sega_range("threshold"):
+                        upper_threshold = concept_state.tail_threshold('noise', sampling_step, concept_out, uncond_out)
+                if concept_state.sparse:
+                        job.noise_edit = self.sega_sparse_edit('noise', concept_out, torch.zeros_like(uncond_out), uncond_out, concept_state, active, job.profiler.stats, upper_threshold, job.profiler)
+                else:
+                        job.noise_edit = self.sega_dense_edit('noise', concept_out, uncond_out, concept_state, active, job.profiler.stats, upper_threshold, profiler=job.profiler)
+
+        def on_cfg_denoiser_callback(self, params: CFGDenoiserParams, concept_store: SegaConceptStore, concept_state: SegaConceptState, profiler: SegaProfiler):
+                with profiler.step(params.x.device):
+                        self.sega_denoiser_step(params, concept_store, concept_state, profiler)
+
+        def sega_denoiser_step(self, params: CFGDenoiserParams, concept_store: SegaConceptStore, concept_state: SegaConceptState, profiler: SegaProfiler):
                 # TODO: add option to opt out of batching for performance
                 sampling_step = params.sampling_step
+
+                # outside of every concept's warmup / cooldown window there is nothing to do, skip reconstruction and all tensor math
+                active_concepts = concept_state.active_concepts(sampling_step)
+                profiler.record_active(active_concepts)
+                if not any(active_concepts):
+                        return
+
                 text_cond = params.text_cond
                 text_uncond = params.text_uncond
 
@@ -204,16 +1097,14 @@ class SegaExtensionScript(scripts.Script):
                 # i would prefer to let sd_samplers_cfg_denoiser.py handle the padding, but
                 # there isn't a callback that returns the padded conds
                 if text_cond.shape[1] != text_uncond.shape[1]:
-                        empty = shared.sd_model.cond_stage_model_empty_prompt
-                        num_repeats = (text_cond.shape[1] - text_uncond.shape[1]) // empty.shape[1]
-
-                        if num_repeats < 0:
-                                text_cond = pad_cond(text_cond, -num_repeats, empty)
-                        elif num_repeats > 0:
-                                text_uncond = pad_cond(text_uncond, num_repeats, empty)
+                        with sega_range("padding"):
+                                empty = shared.sd_model.cond_stage_model_empty_prompt
+                                num_repeats = (text_cond.shape[1] - text_uncond.shape[1]) // empty.shape[1]
 
-                batch_conds_list = []
-                batch_tensor = {}
+                                if num_repeats < 0:
+                                        text_cond = pad_cond(text_cond, -num_repeats, empty)
+                                elif num_repeats > 0:
+                                        text_uncond = pad_cond(text_uncond, num_repeats, empty)
 
                 # sd 1.5 support
                 if isinstance(text_cond, torch.Tensor):
@@ -221,118 +1112,93 @@ class SegaExtensionScript(scripts.Script):
                 if isinstance(text_uncond, torch.Tensor):
                         text_uncond = {'crossattn': text_uncond}
 
-                for i, _ in enumerate(sega_params):
-                        concept_cond, _ = concept_conds[i]
-                        conds_list, tensor_dict = reconstruct_multicond_batch(concept_cond, sampling_step)
-
-                        # sd 1.5 support
-                        if isinstance(tensor_dict, torch.Tensor):
-                                tensor_dict = {'crossattn': tensor_dict}
-
-                        # initialize here because we don't know the shape/dtype of the tensor until we reconstruct it
-                        for key, tensor in tensor_dict.items():
-                                if tensor.shape[1] != text_uncond[key].shape[1]:
-                                        empty = shared.sd_model.cond_stage_model_empty_prompt
-                                        num_repeats = (tensor.shape[1] - text_uncond.shape[1]) // empty.shape[1]
-                                        if num_repeats < 0:
-                                                tensor = pad_cond(tensor, -num_repeats, empty)
-                                tensor = tensor.unsqueeze(0)
-                                if key not in batch_tensor.keys():
-                                        batch_tensor[key] = tensor
-                                else:
-                                        batch_tensor[key] = torch.cat((batch_tensor[key], tensor), dim=0)
-                        batch_conds_list.append(conds_list)
-                self.sega_routine_batch(params, batch_conds_list, batch_tensor, sega_params, text_cond, text_uncond)
-        
-        def make_tuple_dim(self, dim):
-                # sd 1.5 support
-                if isinstance(dim, torch.Tensor):
-                        dim = dim.dim()
-                return (-1,) + (1,) * (dim - 1)
-
-        def sega_routine_batch(self, params: CFGDenoiserParams, batch_conds_list, batch_tensor, sega_params: list[SegaStateParams], text_cond, text_uncond):
-                # FIXME: these parameters should be specific to each concept
-                warmup_period = sega_params[0].warmup_period
-                edit_guidance_scale = sega_params[0].edit_guidance_scale
-                tail_percentage_threshold = sega_params[0].tail_percentage_threshold
-                momentum_scale = sega_params[0].momentum_scale
-                momentum_beta = sega_params[0].momentum_beta
+                # batch_tensor: [num_concepts, batch_size, tokens(77, 154, etc.), 2048], only rebuilt when a scheduled concept prompt changes
+                batch_tensor = concept_store.get(sampling_step, text_uncond, params.total_sampling_steps, profiler)
+                self.sega_routine_batch(params, batch_tensor, concept_state, active_concepts, text_cond, text_uncond, profiler.stats, profiler)
 
+        def sega_routine_batch(self, params: CFGDenoiserParams, batch_tensor, concept_state: SegaConceptState, active_concepts: list[bool], text_cond, text_uncond, profile_stats: dict = None, profiler: SegaProfiler = None):
                 sampling_step = params.sampling_step
 
                 # Semantic Guidance
-                edit_dir_dict = {}
-
                 # batch_tensor: [num_concepts, batch_size, tokens(77, 154, etc.), 2048]
-                # Calculate edit direction
                 for key, concept_cond in batch_tensor.items():
-                        new_shape = self.make_tuple_dim(concept_cond)
-                        strength = torch.Tensor([params.strength for params in sega_params]).to(dtype=concept_cond.dtype, device=concept_cond.device)
-                        strength = strength.view(new_shape)
+                        # concepts outside of their own warmup / cooldown window are masked out
+                        active = None if all(active_concepts) else concept_state.active_mask(active_concepts, concept_cond)
 
-                        if key not in edit_dir_dict.keys():
-                                edit_dir_dict[key] = torch.zeros_like(concept_cond, dtype=concept_cond.dtype, device=concept_cond.device)
+                        # add to cond, the callback only gets here once at least one concept is active
+                        # for sd 1.5, we must add to the original params.text_cond because we reassigned text_cond
+                        cond = params.text_cond[key] if isinstance(params.text_cond, dict) else params.text_cond
+                        with sega_range("threshold"):
+                                upper_threshold = concept_state.tail_threshold(key, sampling_step, concept_cond, text_uncond[key])
+                        if concept_state.sparse:
+                                cond = self.sega_sparse_edit(key, concept_cond, cond, text_uncond[key], concept_state, active, profile_stats, upper_threshold, profiler)
+                        else:
+                                # the webui reconstructs the conditioning every step, so it is safe to add to in-place
+                                cond = self.sega_dense_edit(key, concept_cond, text_uncond[key], concept_state, active, profile_stats, upper_threshold, out=cond, profiler=profiler)
+                        if isinstance(params.text_cond, dict):
+                                params.text_cond[key] = cond
+                        else:
+                                params.text_cond = cond
 
-                        # filter out values in-between tails
-                        # FIXME: does this take into account image batch size?, i.e. dim 1
-                        inside_dim = tuple(range(-concept_cond.dim() + 1, 0)) # for tensor of dim 4, returns (-3, -2, -1), for tensor of dim 3, returns (-2, -1)
-                        cond_mean, cond_std = torch.mean(concept_cond, dim=inside_dim), torch.std(concept_cond, dim=inside_dim)
+        def sega_dense_edit(self, key: str, concept_cond, uncond, concept_state: SegaConceptState, active, profile_stats: dict = None, upper_threshold=None, out=None, profiler: SegaProfiler = None):
+                """ Edit direction summed over all concepts, added to out in-place if given """
+                concept_params = concept_state.tensors(concept_cond)
+                velocity = concept_state.get_velocity(key, concept_cond)
 
-                        # broadcast element-wise subtraction
-                        edit_dir = concept_cond - text_uncond[key]
+                # stream concepts in chunks that fit the memory budget, slices are views so velocity is still updated in-place
+                chunk_size = concept_chunk_size(concept_cond)
+                for start in range(0, concept_cond.shape[0], chunk_size):
+                        chunk = slice(start, start + chunk_size)
+                        chunk_edit_dir = run_guidance_kernel(
+                                concept_cond[chunk],
+                                uncond,
+                                velocity[chunk],
+                                concept_params['strength'][chunk],
+                                concept_params['upper_z'][chunk],
+                                concept_params['edit_guidance_scale'][chunk],
+                                concept_params['momentum_scale'][chunk],
+                                concept_params['momentum_beta'][chunk],
+                                active[chunk] if active is not None else None,
+                                profile_stats,
+                                upper_threshold[chunk] if upper_threshold is not None else None,
+                        )
+                        out = chunk_edit_dir if out is None else out.add_(chunk_edit_dir)
+                        if profiler is not None:
+                                profiler.sample()
+                        del chunk_edit_dir
+                return out
 
-                        # multiply by strength for positive / negative direction
-                        edit_dir = torch.mul(strength, edit_dir)
+        def sega_sparse_edit(self, key: str, concept_cond, cond, uncond, concept_state: SegaConceptState, active, profile_stats: dict = None, upper_threshold=None, profiler: SegaProfiler = None):
+                """ cond with the edit direction of all concepts scatter-added at the selected elements only """
+                concept_params = concept_state.tensors(concept_cond)
+                flat_indices, values = [], []
+                selected_elements = 0
+                chunk_size = concept_chunk_size(concept_cond, velocity=False)
+                for start in range(0, concept_cond.shape[0], chunk_size):
+                        chunk = slice(start, start + chunk_size)
+                        flat_idx, chunk_values = sega_sparse_guidance_kernel(
+                                concept_cond[chunk],
+                                uncond,
+                                concept_params['strength'][chunk],
+                                concept_params['upper_z'][chunk],
+                                concept_params['edit_guidance_scale'][chunk],
+                                active[chunk] if active is not None else None,
+                                profile_stats,
+                                upper_threshold[chunk] if upper_threshold is not None else None,
+                        )
+                        flat_indices.append(flat_idx)
+                        values.append(chunk_values)
+                        selected_elements += flat_idx.nelement()
+                        if profiler is not None:
+                                profiler.sample()
 
-                        # z-scores for tails
-                        upper_z = stats.norm.ppf(1.0 - tail_percentage_threshold)
+                # too many elements for the sparse path to pay off, use dense guidance for the rest of the generation
+                if selected_elements > SEGA_SPARSE_DENSITY * concept_cond.nelement():
+                        logger.debug('Switching to dense guidance, %d of %d elements selected', selected_elements, concept_cond.nelement())
+                        concept_state.sparse = False
 
-                        # numerical thresholds
-                        # FIXME: does this take into account image batch size?, i.e. dim 1
-                        upper_threshold = cond_mean + (upper_z * cond_std)
-
-                        # reshape to be able to broadcast / use torch.where to filter out values for each concept
-                        #new_shape = (-1,) + (1,) * (concept_cond.dim() - 1)
-                        new_shape = self.make_tuple_dim(concept_cond)
-                        upper_threshold_reshaped = upper_threshold.view(new_shape)
-
-                        # zero out values in-between tails
-                        # elementwise multiplication between scale tensor and edit direction
-                        zero_tensor = torch.zeros_like(concept_cond, dtype=concept_cond.dtype, device=concept_cond.device)
-                        scale_tensor = torch.ones_like(concept_cond, dtype=concept_cond.dtype, device=concept_cond.device) * edit_guidance_scale
-                        edit_dir_abs = edit_dir.abs()
-                        scale_tensor = torch.where((edit_dir_abs > upper_threshold_reshaped), scale_tensor, zero_tensor)
-
-                        # update edit direction with the edit dir for this concept
-                        guidance_strength = 0.0 if sampling_step < warmup_period else 1.0 # FIXME: Use appropriate guidance strength
-                        edit_dir = torch.mul(scale_tensor, edit_dir)
-                        edit_dir_dict[key] = edit_dir_dict[key] + guidance_strength * edit_dir
-
-                # TODO: batch this
-                for i, sega_param in enumerate(sega_params):
-                        for key, dir in edit_dir_dict.items():
-                                # calculate momentum scale and velocity
-                                if key not in sega_param.v.keys():
-                                        slice_idx = 1 - dir.dim() # should be negative, for dim=4, slice_idx = -3
-                                        sega_param.v[key] = torch.zeros(dir.shape[slice_idx:], dtype=dir.dtype, device=dir.device)
-
-                                # add to text condition
-                                v_t = sega_param.v[key]
-                                dir[i] = dir[i] + torch.mul(momentum_scale, v_t)
-
-                                # calculate v_t+1 and update state
-                                v_t_1 = momentum_beta * ((1 - momentum_beta) * v_t) * dir[i]
-
-                                # add to cond after warmup elapsed
-                                # for sd 1.5, we must add to the original params.text_cond because we reassigned text_cond
-                                if sampling_step >= warmup_period:
-                                        if isinstance(params.text_cond, dict):
-                                                params.text_cond[key] = params.text_cond[key] + dir[i]
-                                        else:
-                                                params.text_cond = params.text_cond + dir[i]
-
-                                # update velocity
-                                sega_param.v[key] = v_t_1
+                with sega_range("scatter"):
+                        return apply_sparse_edit(cond, uncond.shape, torch.cat(flat_indices), torch.cat(values))
 
 # XYZ Plot
 # Based on @mcmonkey4eva's XYZ Plot implementation here: https://github.com/mcmonkeyprojects/sd-dynamic-thresholding/blob/master/scripts/dynamic_thresholding.py
@@ -359,10 +1225,13 @@ def make_axis_options():
                 xyz_grid.AxisOption("[Semantic Guidance] Prompt", str, sega_apply_field("sega_prompt")),
                 xyz_grid.AxisOption("[Semantic Guidance] Negative Prompt", str, sega_apply_field("sega_neg_prompt")),
                 xyz_grid.AxisOption("[Semantic Guidance] Warmup Steps", int, sega_apply_field("sega_warmup")),
+                xyz_grid.AxisOption("[Semantic Guidance] Cooldown Step", int, sega_apply_field("sega_cooldown")),
                 xyz_grid.AxisOption("[Semantic Guidance] Guidance Scale", float, sega_apply_field("sega_edit_guidance_scale")),
                 xyz_grid.AxisOption("[Semantic Guidance] Tail Percentage Threshold", float, sega_apply_field("sega_tail_percentage_threshold")),
+                xyz_grid.AxisOption("[Semantic Guidance] Threshold Mode", str, sega_apply_field("sega_threshold_mode"), choices=lambda: THRESHOLD_MODES),
                 xyz_grid.AxisOption("[Semantic Guidance] Momentum Scale", float, sega_apply_field("sega_momentum_scale")),
                 xyz_grid.AxisOption("[Semantic Guidance] Momentum Beta", float, sega_apply_field("sega_momentum_beta")),
+                xyz_grid.AxisOption("[Semantic Guidance] Guidance Space", str, sega_apply_field("sega_guidance_space"), choices=lambda: GUIDANCE_SPACES),
         }
         #if not any("[Semantic Guidance]" in x.label for x in xyz_grid.axis_options):
                 #xyz_grid.axis_options.extend(extra_axis_options)
@@ -379,4 +1248,39 @@ def callback_before_ui():
         except:
                 logger.exception("Semantic Guidance: Error while making axis options")
 
+def callback_cfg_denoiser(params: CFGDenoiserParams):
+        job = sega_jobs.get(params)
+        if job is None:
+                return
+        if job.guidance_space == "Noise":
+                job.script.on_cfg_denoiser_noise_callback(params, job)
+        else:
+                job.script.on_cfg_denoiser_callback(params, job.concept_store, job.concept_state, job.profiler)
+
+def callback_cfg_denoised(params: CFGDenoisedParams):
+        job = sega_jobs.get(params)
+        if job is None or job.guidance_space != "Noise":
+                return
+        job.script.on_cfg_denoised_noise_callback(params, job)
+
+def callback_cfg_after_cfg(params: AfterCFGCallbackParams):
+        job = sega_jobs.get(params)
+        if job is None or job.guidance_space != "Noise":
+                return
+        job.script.on_cfg_after_cfg_noise_callback(params, job)
+
+def callback_script_unloaded():
+        sega_jobs.release_all()
+        shutdown_prefetch()
+
+def callback_model_loaded(sd_model):
+        logger.debug('Clearing concept conditioning cache: %s', concept_cond_cache.stats())
+        concept_cond_cache.clear()
+        concept_store_cache.clear()
+
 script_callbacks.on_before_ui(callback_before_ui)
+script_callbacks.on_model_loaded(callback_model_loaded)
+script_callbacks.on_cfg_denoiser(callback_cfg_denoiser)
+script_callbacks.on_cfg_denoised(callback_cfg_denoised)
+script_callbacks.on_cfg_after_cfg(callback_cfg_after_cfg)
+script_callbacks.on_script_unloaded(callback_script_unloaded)
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import benchmark_sega # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def sega_runtime():
+        """ scripts/sega.py loaded once against the stub webui modules of the benchmark """
+        return benchmark_sega.load_sega()
+
+
+@pytest.fixture
+def sega(sega_runtime, monkeypatch):
+        """ The sega module with dense guidance, no prefetch and empty caches, all jobs are released afterwards """
+        sega, stubs = sega_runtime
+        monkeypatch.setattr(sega, 'SEGA_MEMORY_BUDGET_MB', 0)
+        monkeypatch.setattr(sega, 'SEGA_SPARSE_DENSITY', 0)
+        monkeypatch.setattr(sega, 'SEGA_PREFETCH', False)
+        monkeypatch.setattr(sega, 'SEGA_COMPILE', False)
+        monkeypatch.setattr(stubs['modules.shared'].state, 'interrupted', False)
+        sega.concept_cond_cache.clear()
+        sega.concept_store_cache.clear()
+        yield sega
+        sega.sega_jobs.release_all()
+
+
+@pytest.fixture
+def stubs(sega_runtime):
+        return sega_runtime[1]
+
+
+@pytest.fixture(params=['sd15', 'sdxl'])
+def stub_model(request, stubs):
+        """ SD 1.5 and SD XL stand-ins for shared.sd_model """
+        model = benchmark_sega.StubModel(request.param, torch.float32, torch.device('cpu'))
+        stubs['modules.shared'].sd_model = model
+        yield model
+        stubs['modules.shared'].sd_model = None
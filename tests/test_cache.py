@@ -0,0 +1,127 @@
+import types
+
+import pytest
+import torch
+
+from benchmark_sega import BenchmarkJob
+
+NUM_CONCEPTS = 2
+
+
+def make_job(sega, stubs, model) -> BenchmarkJob:
+        config = {'model': model.model, 'num_concepts': NUM_CONCEPTS, 'batch_size': 1, 'tokens': 77, 'steps': 4}
+        return BenchmarkJob(sega, stubs, config, torch.device('cpu'))
+
+
+def cache_counts(sega) -> tuple:
+        return sega.concept_cond_cache.hits, sega.concept_cond_cache.misses
+
+
+def test_entries_are_evicted_by_count(sega):
+        cache = sega.SegaConditioningCache(2, 1000)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        # a was used last, so b is the least recently used entry
+        assert cache.get('a') == 1
+        cache.put('c', 3, 10)
+        assert list(cache.entries) == ['a', 'c']
+        assert cache.get('b') is None
+        assert cache.total_bytes == 20
+
+
+def test_entries_are_evicted_by_bytes(sega):
+        cache = sega.SegaConditioningCache(10, 100)
+        cache.put('a', 1, 60)
+        cache.put('b', 2, 30)
+        cache.put('c', 3, 30)
+        assert list(cache.entries) == ['b', 'c']
+        assert cache.total_bytes == 60
+        # replacing an entry releases its old size
+        cache.put('b', 4, 50)
+        assert list(cache.entries) == ['c', 'b']
+        assert cache.total_bytes == 80
+
+
+def test_oversized_entries_are_not_stored(sega):
+        cache = sega.SegaConditioningCache(10, 100)
+        cache.put('a', 1, 60)
+        cache.put('b', 2, 101)
+        assert list(cache.entries) == ['a']
+        assert cache.total_bytes == 60
+        # an oversized value also drops the stale entry of its key
+        cache.put('a', 3, 101)
+        assert cache.entries == {}
+        assert cache.total_bytes == 0
+
+
+def test_concepts_are_encoded_once_across_jobs(sega, stubs, stub_model):
+        hits, misses = cache_counts(sega)
+        for _ in range(2):
+                job = make_job(sega, stubs, stub_model)
+                job.start()
+                job.finish()
+        assert cache_counts(sega) == (hits + NUM_CONCEPTS, misses + NUM_CONCEPTS)
+        # the text and uncond prompts of both jobs, and every concept once
+        assert stub_model.encoded_prompts == 2 * 2 + NUM_CONCEPTS
+
+
+def test_model_loaded_clears_the_caches(sega, stubs, stub_model):
+        job = make_job(sega, stubs, stub_model)
+        job.start()
+        job.finish()
+        assert len(sega.concept_cond_cache.entries) == NUM_CONCEPTS
+        assert len(sega.concept_store_cache.entries) == 1
+
+        sega.callback_model_loaded(stub_model)
+        assert sega.concept_cond_cache.entries == {}
+        assert sega.concept_cond_cache.total_bytes == 0
+        assert sega.concept_store_cache.entries == {}
+
+
+@pytest.mark.parametrize('change', ['width', 'height', 'steps', 'sd_model_hash', 'extra_network_data'])
+def test_conditioning_inputs_are_part_of_the_key(sega, stubs, stub_model, change):
+        job = make_job(sega, stubs, stub_model)
+        job.start()
+        job.finish()
+        if change == 'sd_model_hash':
+                stub_model.sd_model_hash = 'other'
+        elif change == 'extra_network_data':
+                job.p.extra_network_data = {'lora': [types.SimpleNamespace(items=['style', '0.8'])]}
+        else:
+                setattr(job.p, change, getattr(job.p, change) * 2)
+
+        hits, misses = cache_counts(sega)
+        encoded_prompts = stub_model.encoded_prompts
+        job.start()
+        job.finish()
+        assert cache_counts(sega) == (hits, misses + NUM_CONCEPTS)
+        assert stub_model.encoded_prompts == encoded_prompts + NUM_CONCEPTS
+
+
+def test_grid_cells_and_hires_passes_reuse_the_concept_tensors(sega, stubs, stub_model, monkeypatch):
+        build = sega.SegaConceptStore.build
+        builds = []
+
+        def counting_build(self, *args, **kwargs):
+                builds.append(self)
+                return build(self, *args, **kwargs)
+
+        monkeypatch.setattr(sega.SegaConceptStore, 'build', counting_build)
+        config = {'model': stub_model.model, 'num_concepts': 2, 'concept_prompts': ['[concept 0:other concept 0:1]', 'concept 1'], 'batch_size': 1, 'tokens': 77, 'steps': 4}
+        encoded_prompts, concept_stores = [], []
+        for sega_params in ({'edit_guidance_scale': 1.0, 'tail_percentage_threshold': 0.05}, {'edit_guidance_scale': 2.0, 'tail_percentage_threshold': 0.1}):
+                job = BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'warmup': 0, **sega_params})
+                before = stub_model.encoded_prompts
+                job.start()
+                encoded_prompts.append(stub_model.encoded_prompts - before)
+                concept_stores.append(sega.sega_jobs.jobs[id(job.p)].concept_store)
+                # the hires-fix pass restarts the step count within the same job
+                for i in range(config['steps'] * 2):
+                        job.step(i)
+                job.finish()
+
+        # both schedules of the first concept and the second concept, only for the first job
+        assert encoded_prompts == [3, 0]
+        # a build per prompt-schedule segment of the first pass, on the store shared by both jobs
+        assert concept_stores[0] is concept_stores[1]
+        assert builds == [concept_stores[0]] * 2
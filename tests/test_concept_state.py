@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+
+def make_state(sega, warmup: list[int], cooldown: list[int]):
+        sega_params = []
+        for warmup_period, cooldown_period in zip(warmup, cooldown):
+                params = sega.SegaStateParams()
+                params.warmup_period = warmup_period
+                params.cooldown_period = cooldown_period
+                sega_params.append(params)
+        return sega.SegaConceptState(sega_params)
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float16, torch.bfloat16])
+def test_active_mask_matches_step_window(sega, dtype):
+        # bfloat16 rounds 257 to 256, the step window must not go through the conditioning dtype
+        concept_state = make_state(sega, warmup=[257, 0, 10], cooldown=[-1, 257, 20])
+        like = torch.zeros((3, 1, 77, 8), dtype=dtype)
+        for sampling_step in (0, 10, 19, 20, 255, 256, 257, 258):
+                active_concepts = concept_state.active_concepts(sampling_step)
+                mask = concept_state.active_mask(active_concepts, like)
+                assert mask.dtype == torch.bool
+                assert mask.shape == (3, 1, 1, 1)
+                assert mask.view(-1).tolist() == active_concepts
+                assert active_concepts == [sampling_step >= 257, sampling_step < 257, 10 <= sampling_step < 20]
@@ -0,0 +1,51 @@
+import pytest
+import torch
+
+from benchmark_sega import BenchmarkJob
+
+STEPS = 6
+SWITCH_STEP = 2
+BATCH_SIZE = 2
+
+
+@pytest.fixture
+def builds(sega, monkeypatch):
+        """ SegaConceptStore.build, recording the sampling step of every build """
+        build = sega.SegaConceptStore.build
+        steps = []
+
+        def counting_build(self, sampling_step, *args, **kwargs):
+                steps.append(sampling_step)
+                return build(self, sampling_step, *args, **kwargs)
+
+        monkeypatch.setattr(sega.SegaConceptStore, 'build', counting_build)
+        return steps
+
+
+def crossattn(cond):
+        return cond['crossattn'] if isinstance(cond, dict) else cond
+
+
+def test_concept_tensors_are_built_once_per_segment(sega, stubs, stub_model, builds, monkeypatch):
+        get = sega.SegaConceptStore.get
+        batch_tensors = []
+
+        def recording_get(self, *args, **kwargs):
+                batch_tensors.append(get(self, *args, **kwargs))
+                return batch_tensors[-1]
+
+        monkeypatch.setattr(sega.SegaConceptStore, 'get', recording_get)
+        config = {'model': stub_model.model, 'num_concepts': 1, 'concept_prompts': [f'[concept a:concept b:{SWITCH_STEP}]'], 'batch_size': BATCH_SIZE, 'tokens': 77, 'steps': STEPS}
+        job = BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'warmup': 0})
+        job.start()
+        for i in range(STEPS):
+                job.step(i)
+        job.finish()
+
+        # end_at_step is inclusive, so the switch step still resolves to the first prompt
+        assert builds == [0, SWITCH_STEP + 1]
+        expected = {'concept a': crossattn(stub_model.batched('concept a', BATCH_SIZE, 77)), 'concept b': crossattn(stub_model.batched('concept b', BATCH_SIZE, 77))}
+        for i, batch_tensor in enumerate(batch_tensors):
+                assert torch.equal(batch_tensor['crossattn'][0], expected['concept a' if i <= SWITCH_STEP else 'concept b'])
+                # the same cached tensors for every step of a segment
+                assert batch_tensor is batch_tensors[0 if i <= SWITCH_STEP else SWITCH_STEP + 1]
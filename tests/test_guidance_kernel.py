@@ -0,0 +1,194 @@
+"""
+Parity of the fused guidance kernel with sega_routine_batch of the original implementation
+"""
+import pytest
+import scipy.stats as stats
+import torch
+
+from benchmark_sega import BenchmarkJob, DictWithShape, copy_cond
+
+STEPS = 4
+WARMUP = 2
+CONCEPT_PROMPTS = ['concept 0', '(concept 1:1.5)']
+NEG_PROMPT = 'concept 2'
+STRENGTHS = [1.0, 1.5, -1.0]
+CONCEPTS = ['concept 0', 'concept 1', 'concept 2']
+
+
+def make_tuple_dim(dim):
+        # sd 1.5 support
+        if isinstance(dim, torch.Tensor):
+                dim = dim.dim()
+        return (-1,) + (1,) * (dim - 1)
+
+
+def reference_routine_batch(params, batch_tensor, strengths, velocities, text_uncond, warmup_period, edit_guidance_scale, tail_percentage_threshold, momentum_scale, momentum_beta):
+        """ sega_routine_batch as it was before the guidance kernel, with the per-concept velocity in `velocities` """
+        sampling_step = params.sampling_step
+
+        # Semantic Guidance
+        edit_dir_dict = {}
+
+        # batch_tensor: [num_concepts, batch_size, tokens(77, 154, etc.), 2048]
+        # Calculate edit direction
+        for key, concept_cond in batch_tensor.items():
+                new_shape = make_tuple_dim(concept_cond)
+                strength = torch.Tensor(strengths).to(dtype=concept_cond.dtype, device=concept_cond.device)
+                strength = strength.view(new_shape)
+
+                if key not in edit_dir_dict.keys():
+                        edit_dir_dict[key] = torch.zeros_like(concept_cond, dtype=concept_cond.dtype, device=concept_cond.device)
+
+                # filter out values in-between tails
+                inside_dim = tuple(range(-concept_cond.dim() + 1, 0))
+                cond_mean, cond_std = torch.mean(concept_cond, dim=inside_dim), torch.std(concept_cond, dim=inside_dim)
+
+                # broadcast element-wise subtraction
+                edit_dir = concept_cond - text_uncond[key]
+
+                # multiply by strength for positive / negative direction
+                edit_dir = torch.mul(strength, edit_dir)
+
+                # z-scores for tails
+                upper_z = stats.norm.ppf(1.0 - tail_percentage_threshold)
+
+                # numerical thresholds
+                upper_threshold = cond_mean + (upper_z * cond_std)
+                upper_threshold_reshaped = upper_threshold.view(new_shape)
+
+                # zero out values in-between tails
+                zero_tensor = torch.zeros_like(concept_cond, dtype=concept_cond.dtype, device=concept_cond.device)
+                scale_tensor = torch.ones_like(concept_cond, dtype=concept_cond.dtype, device=concept_cond.device) * edit_guidance_scale
+                edit_dir_abs = edit_dir.abs()
+                scale_tensor = torch.where((edit_dir_abs > upper_threshold_reshaped), scale_tensor, zero_tensor)
+
+                # update edit direction with the edit dir for this concept
+                guidance_strength = 0.0 if sampling_step < warmup_period else 1.0
+                edit_dir = torch.mul(scale_tensor, edit_dir)
+                edit_dir_dict[key] = edit_dir_dict[key] + guidance_strength * edit_dir
+
+        for i, v in enumerate(velocities):
+                for key, dir in edit_dir_dict.items():
+                        # calculate momentum scale and velocity
+                        if key not in v.keys():
+                                slice_idx = 1 - dir.dim()
+                                v[key] = torch.zeros(dir.shape[slice_idx:], dtype=dir.dtype, device=dir.device)
+
+                        # add to text condition
+                        v_t = v[key]
+                        dir[i] = dir[i] + torch.mul(momentum_scale, v_t)
+
+                        # calculate v_t+1 and update state
+                        v_t_1 = momentum_beta * ((1 - momentum_beta) * v_t) * dir[i]
+
+                        # add to cond after warmup elapsed
+                        if sampling_step >= warmup_period:
+                                if isinstance(params.text_cond, dict):
+                                        params.text_cond[key] = params.text_cond[key] + dir[i]
+                                else:
+                                        params.text_cond = params.text_cond + dir[i]
+
+                        # update velocity
+                        v[key] = v_t_1
+
+
+def run_job(sega, stubs, model) -> tuple:
+        """ Conditioning after the denoiser callback on every step of a job with mixed positive / negative concepts """
+        config = {'model': model.model, 'num_concepts': len(CONCEPT_PROMPTS), 'concept_prompts': CONCEPT_PROMPTS, 'batch_size': 2, 'tokens': 77, 'steps': STEPS}
+        job = BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'neg_prompt': NEG_PROMPT, 'warmup': WARMUP})
+        job.start()
+        outputs = [job.step(i).text_cond for i in range(STEPS)]
+        job.finish()
+        return job, outputs
+
+
+def run_reference(job, model) -> list:
+        p = job.p
+        batch_size = job.config['batch_size']
+        encoded = [model.encode(concept) for concept in CONCEPTS]
+        if not isinstance(encoded[0], dict):
+                encoded = [{'crossattn': cond} for cond in encoded]
+        batch_tensor = {key: torch.stack([cond[key] for cond in encoded]).unsqueeze(1).repeat_interleave(batch_size, dim=1) for key in encoded[0]}
+        text_uncond = job.text_uncond if isinstance(job.text_uncond, dict) else {'crossattn': job.text_uncond}
+
+        velocities = [{} for _ in STRENGTHS]
+        outputs = []
+        for i in range(STEPS):
+                text_cond = DictWithShape(job.text_cond) if isinstance(job.text_cond, dict) else job.text_cond
+                params = job.callbacks.CFGDenoiserParams(job.x, None, None, i, STEPS, text_cond, job.text_uncond)
+                reference_routine_batch(params, batch_tensor, STRENGTHS, velocities, text_uncond, p.sega_warmup, p.sega_edit_guidance_scale, p.sega_tail_percentage_threshold, p.sega_momentum_scale, p.sega_momentum_beta)
+                outputs.append(params.text_cond)
+        return outputs
+
+
+def assert_outputs_close(outputs, expected):
+        for step, (output, reference) in enumerate(zip(outputs, expected)):
+                if not isinstance(output, dict):
+                        output, reference = {'crossattn': output}, {'crossattn': reference}
+                assert output.keys() == reference.keys()
+                for key in reference:
+                        assert torch.allclose(output[key], reference[key], rtol=1e-5, atol=1e-5), f'step {step}, {key}'
+
+
+def test_reference_applies_guidance_after_warmup(sega, stubs, stub_model):
+        job, _ = run_job(sega, stubs, stub_model)
+        expected = run_reference(job, stub_model)
+        text_cond = job.text_cond if isinstance(job.text_cond, dict) else {'crossattn': job.text_cond}
+        for step, output in enumerate(expected):
+                output = output if isinstance(output, dict) else {'crossattn': output}
+                changed = any(not torch.equal(output[key], text_cond[key]) for key in text_cond)
+                assert changed == (step >= WARMUP)
+
+
+def test_eager_kernel_matches_reference(sega, stubs, stub_model):
+        job, outputs = run_job(sega, stubs, stub_model)
+        assert_outputs_close(outputs, run_reference(job, stub_model))
+
+
+def test_chunked_kernel_matches_reference(sega, stubs, stub_model, monkeypatch):
+        # a budget below a single concept processes one concept per chunk
+        monkeypatch.setattr(sega, 'SEGA_MEMORY_BUDGET_MB', 1e-6)
+        assert sega.concept_chunk_size(torch.zeros((len(STRENGTHS), 2, 77, stub_model.dim))) == 1
+        job, outputs = run_job(sega, stubs, stub_model)
+        assert_outputs_close(outputs, run_reference(job, stub_model))
+
+
+def test_compiled_kernel_matches_reference(sega, stubs, stub_model, monkeypatch):
+        try:
+                torch.compile(lambda x: x + 1)(torch.ones(1))
+        except Exception as e:
+                pytest.skip(f'torch.compile unavailable: {e}')
+        monkeypatch.setattr(sega, 'SEGA_COMPILE', True)
+        monkeypatch.setattr(sega, '_compiled_guidance_kernel', None)
+        job, outputs = run_job(sega, stubs, stub_model)
+        # run_guidance_kernel turns SEGA_COMPILE off when it falls back to the eager kernel
+        assert sega.SEGA_COMPILE
+        assert sega._compiled_guidance_kernel is not sega.sega_guidance_kernel
+        assert_outputs_close(outputs, run_reference(job, stub_model))
+
+
+def test_chunk_size_budget_includes_velocity(sega):
+        concept_cond = torch.zeros((4, 1, 77, 768))
+        concept_nbytes = concept_cond[0].nelement() * concept_cond.element_size()
+        # the velocity of all 4 concepts and the temporaries of 2 concepts
+        memory_budget_mb = (4 + 2 * sega.KERNEL_TEMPORARIES) * concept_nbytes / (1024 * 1024)
+        assert sega.concept_chunk_size(concept_cond, memory_budget_mb) == 2
+        assert sega.concept_chunk_size(concept_cond, memory_budget_mb, velocity=False) == 4
+        assert sega.concept_chunk_size(concept_cond, concept_nbytes / (1024 * 1024)) == 1
+
+
+def test_edit_is_added_to_the_conditioning_in_place(sega, stubs, stub_model):
+        config = {'model': stub_model.model, 'num_concepts': len(CONCEPT_PROMPTS), 'concept_prompts': CONCEPT_PROMPTS, 'batch_size': 2, 'tokens': 77, 'steps': STEPS}
+        job = BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'neg_prompt': NEG_PROMPT, 'warmup': 0})
+        job.start()
+        text_cond = copy_cond(job.text_cond)
+        tensors = dict(text_cond) if isinstance(text_cond, dict) else {'crossattn': text_cond}
+        params = job.callbacks.CFGDenoiserParams(job.x, None, None, 0, STEPS, text_cond, job.text_uncond)
+        job.callbacks.cfg_denoiser_callback(params)
+        job.finish()
+
+        output = params.text_cond if isinstance(params.text_cond, dict) else {'crossattn': params.text_cond}
+        original = job.text_cond if isinstance(job.text_cond, dict) else {'crossattn': job.text_cond}
+        for key, tensor in tensors.items():
+                assert output[key] is tensor
+        assert any(not torch.equal(output[key], original[key]) for key in original)
@@ -0,0 +1,41 @@
+import gc
+import types
+
+import torch
+
+from benchmark_sega import BenchmarkJob, StubModel, run_jobs
+
+JOBS = 1000
+
+
+def test_jobs_leave_no_state_behind(sega, stubs):
+        # completed, interrupted and failed jobs in turn, sampled after the first job and every hundredth job
+        report = run_jobs(sega, stubs, types.SimpleNamespace(jobs=JOBS, device='cpu'))
+        samples = report['samples']
+        assert [sample['jobs'] for sample in samples] == [1] + list(range(JOBS // 10, JOBS + 1, JOBS // 10))
+        assert len({sample['callbacks'] for sample in samples}) == 1
+        assert all(sample['registered_jobs'] == 0 for sample in samples)
+        assert len(sega.sega_jobs.finalizers) == 0
+        # the caches are warm once every outcome ran
+        warm_bytes = samples[1]['live_tensor_bytes']
+        assert all(sample['live_tensor_bytes'] <= warm_bytes for sample in samples[2:])
+
+
+def test_batches_of_one_job_share_a_finalizer(sega, stubs):
+        stubs['modules.shared'].sd_model = StubModel('sd15', torch.float32, torch.device('cpu'))
+        config = {'model': 'sd15', 'num_concepts': 2, 'batch_size': 1, 'tokens': 77, 'steps': 2}
+        job = BenchmarkJob(sega, stubs, config, torch.device('cpu'))
+        # n_iter > 1 runs process_batch / postprocess_batch on the same p for every batch
+        for _ in range(3):
+                job.start()
+                job.step(0)
+                job.finish()
+        assert list(sega.sega_jobs.finalizers) == [id(job.p)]
+
+        # a failed batch is released once p is garbage collected
+        job.start()
+        assert len(sega.sega_jobs.jobs) == 1
+        del job
+        gc.collect()
+        assert len(sega.sega_jobs.jobs) == 0
+        assert len(sega.sega_jobs.finalizers) == 0
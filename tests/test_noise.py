@@ -0,0 +1,129 @@
+import logging
+
+import torch
+
+from benchmark_sega import BenchmarkJob, StubDenoiser, copy_cond
+
+BATCH_SIZE = 2
+NUM_CONCEPTS = 3
+STEPS = 4
+
+
+def make_job(sega, stubs, model, sega_params: dict = None) -> BenchmarkJob:
+        config = {'model': model.model, 'num_concepts': NUM_CONCEPTS, 'batch_size': BATCH_SIZE, 'tokens': 77, 'steps': STEPS}
+        return BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'warmup': 0, 'guidance_space': "Noise", **(sega_params or {})})
+
+
+def make_latents() -> tuple:
+        generator = torch.Generator().manual_seed(0)
+        x = torch.randn((BATCH_SIZE, 4, 8, 8), generator=generator)
+        sigma = torch.rand((BATCH_SIZE,), generator=generator) + 0.5
+        return x, sigma
+
+
+def crossattn(cond):
+        return cond['crossattn'] if isinstance(cond, dict) else cond
+
+
+def test_concept_rows_are_inserted_before_the_uncond_rows(sega, stubs, stub_model):
+        job = make_job(sega, stubs, stub_model)
+        denoiser = StubDenoiser(job.callbacks, job.p)
+        job.start()
+        x, sigma = make_latents()
+        x_in = torch.cat([x, x + 1])
+        sigma_in = torch.cat([sigma, sigma + 1])
+        params = job.callbacks.CFGDenoiserParams(x_in, None, sigma_in, 0, STEPS, copy_cond(job.text_cond), job.text_uncond, denoiser)
+        job.callbacks.cfg_denoiser_callback(params)
+
+        sega_job = sega.sega_jobs.get(params)
+        assert sega_job.noise_rows == (BATCH_SIZE, NUM_CONCEPTS, BATCH_SIZE)
+        # cond rows, a block of uncond latents per concept, uncond rows
+        expected_x = torch.cat([x] + [x + 1] * NUM_CONCEPTS + [x + 1])
+        assert torch.equal(params.x, expected_x)
+        assert torch.equal(params.sigma, torch.cat([sigma] + [sigma + 1] * NUM_CONCEPTS + [sigma + 1]))
+        text_cond = crossattn(params.text_cond)
+        assert text_cond.shape[0] == BATCH_SIZE * (1 + NUM_CONCEPTS)
+        assert torch.equal(text_cond[:BATCH_SIZE], crossattn(job.text_cond))
+        for i in range(NUM_CONCEPTS):
+                concept_rows = text_cond[BATCH_SIZE * (i + 1):BATCH_SIZE * (i + 2)]
+                assert torch.equal(concept_rows, crossattn(stub_model.batched(f'concept {i}', BATCH_SIZE, 77)))
+        job.finish()
+
+
+def test_unsupported_batch_layout_is_skipped(sega, stubs, stub_model, caplog):
+        job = make_job(sega, stubs, stub_model)
+        denoiser = StubDenoiser(job.callbacks, job.p)
+        job.start()
+        x, sigma = make_latents()
+        # an edit model batch, with an extra block of rows per image
+        x_in = torch.cat([x, x, x])
+        sigma_in = torch.cat([sigma, sigma, sigma])
+        with caplog.at_level(logging.WARNING):
+                for step in range(2):
+                        text_cond = copy_cond(job.text_cond)
+                        params = job.callbacks.CFGDenoiserParams(x_in, None, sigma_in, step, STEPS, text_cond, job.text_uncond, denoiser)
+                        job.callbacks.cfg_denoiser_callback(params)
+                        assert params.x is x_in
+                        assert params.sigma is sigma_in
+                        assert crossattn(params.text_cond).shape[0] == BATCH_SIZE
+                        assert sega.sega_jobs.get(params).noise_rows is None
+        assert len([record for record in caplog.records if 'batch of' in record.getMessage()]) == 1
+        job.finish()
+
+
+def test_zero_scale_keeps_the_cfg_result(sega, stubs, stub_model):
+        x, sigma = make_latents()
+        outputs = {}
+        for mode, sega_params in (('off', {'active': False}), ('noise', {'edit_guidance_scale': 0.0})):
+                job = make_job(sega, stubs, stub_model, sega_params)
+                denoiser = StubDenoiser(job.callbacks, job.p)
+                job.start()
+                outputs[mode] = [denoiser(x, sigma, i, STEPS, job.text_cond, job.text_uncond) for i in range(STEPS)]
+                rows = denoiser.rows
+                job.finish()
+                assert rows == BATCH_SIZE * (2 + (NUM_CONCEPTS if mode == 'noise' else 0))
+        for off, noise in zip(outputs['off'], outputs['noise']):
+                assert torch.allclose(noise, off, rtol=1e-6, atol=1e-6)
+
+
+def test_noise_edit_matches_the_kernel(sega, stubs, stub_model):
+        x, sigma = make_latents()
+        outputs = {}
+        for mode, sega_params in (('off', {'active': False}), ('noise', {'edit_guidance_scale': 3.0, 'tail_percentage_threshold': 0.5})):
+                job = make_job(sega, stubs, stub_model, sega_params)
+                denoiser = StubDenoiser(job.callbacks, job.p)
+                job.start()
+                outputs[mode] = denoiser(x, sigma, 0, STEPS, job.text_cond, job.text_uncond)
+                job.finish()
+
+        # the edit direction between the concept and uncond predictions, computed without batching
+        uncond_out = denoiser.inner_model(x, sigma, job.text_uncond)
+        concept_out = torch.stack([denoiser.inner_model(x, sigma, stub_model.batched(f'concept {i}', BATCH_SIZE, 77)) for i in range(NUM_CONCEPTS)])
+        ones = torch.ones((NUM_CONCEPTS, 1, 1, 1, 1))
+        edit_dir = sega.sega_guidance_kernel(concept_out, uncond_out, torch.zeros_like(concept_out), ones, ones * sega.tail_z_score(0.5), ones * 3.0, ones * 0.3, ones * 0.6)
+        assert edit_dir.abs().max() > 0
+        assert torch.allclose(outputs['noise'], outputs['off'] + edit_dir, rtol=1e-5, atol=1e-5)
+
+
+def test_steps_without_uncond_pass_get_no_guidance(sega, stubs, stub_model, monkeypatch):
+        # every sigma is below s_min_uncond, so the webui skips the uncond pass on every other step
+        monkeypatch.setattr(stubs['modules.shared'].opts, 's_min_uncond', 10.0)
+        x, sigma = make_latents()
+        outputs, rows = {}, {}
+        for mode, sega_params in (('off', {'active': False}), ('noise', {'edit_guidance_scale': 3.0, 'tail_percentage_threshold': 0.5})):
+                job = make_job(sega, stubs, stub_model, sega_params)
+                denoiser = StubDenoiser(job.callbacks, job.p)
+                job.start()
+                outputs[mode], rows[mode] = [], []
+                for i in range(STEPS):
+                        outputs[mode].append(denoiser(x, sigma, i, STEPS, job.text_cond, job.text_uncond))
+                        rows[mode].append(denoiser.rows)
+                job.finish()
+
+        assert rows['off'] == [2 * BATCH_SIZE, BATCH_SIZE] * (STEPS // 2)
+        assert rows['noise'] == [(2 + NUM_CONCEPTS) * BATCH_SIZE, BATCH_SIZE] * (STEPS // 2)
+        for i in range(STEPS):
+                if i % 2:
+                        assert torch.equal(outputs['noise'][i], outputs['off'][i])
+                else:
+                        assert not torch.allclose(outputs['noise'][i], outputs['off'][i])
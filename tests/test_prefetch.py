@@ -0,0 +1,129 @@
+import gc
+import threading
+import time
+
+import pytest
+import torch
+
+from benchmark_sega import BenchmarkJob, StubDenoiser
+
+STEPS = 4
+BUILD_SECONDS = 0.05
+
+
+@pytest.fixture
+def builds(sega, monkeypatch):
+        """ Slowed down SegaConceptStore.build, recording the thread of every build """
+        build = sega.SegaConceptStore.build
+        threads = []
+
+        def slow_build(self, *args, **kwargs):
+                threads.append(threading.current_thread().name)
+                time.sleep(BUILD_SECONDS)
+                return build(self, *args, **kwargs)
+
+        monkeypatch.setattr(sega.SegaConceptStore, 'build', slow_build)
+        return threads
+
+
+@pytest.fixture
+def blocked_worker(sega):
+        """ Keeps the prefetch worker busy, so submitted prefetches stay pending until the gate opens """
+        gate = threading.Event()
+        sega.get_prefetch_executor().submit(gate.wait)
+        yield gate
+        gate.set()
+
+
+def make_job(sega, stubs, model) -> BenchmarkJob:
+        # the concept prompt switches after step 1, so step 2 starts a new segment
+        config = {'model': model.model, 'num_concepts': 1, 'concept_prompts': ['[concept 0:other concept 0:1]'], 'batch_size': 1, 'tokens': 77, 'steps': STEPS}
+        return BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'warmup': 0})
+
+
+def segment_get_seconds(sega, stubs, stub_model, monkeypatch) -> float:
+        """ Time spent getting the concept tensors on the first step of the second segment, behind a slow denoiser """
+        get = sega.SegaConceptStore.get
+        get_seconds = []
+
+        def timed_get(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                        return get(self, *args, **kwargs)
+                finally:
+                        get_seconds.append(time.perf_counter() - start)
+
+        monkeypatch.setattr(sega.SegaConceptStore, 'get', timed_get)
+        # nothing is built for a store left in the cache by a previous job
+        sega.concept_store_cache.clear()
+        job = make_job(sega, stubs, stub_model)
+        # the denoiser takes longer than a build, so a prefetched build is done by the next step
+        denoiser = StubDenoiser(job.callbacks, job.p, unet_ms_per_row=BUILD_SECONDS * 1000)
+        job.start()
+        x = torch.randn((1, 4, 8, 8))
+        sigma = torch.ones((1,))
+        for i in range(STEPS):
+                denoiser(x, sigma, i, STEPS, job.text_cond, job.text_uncond)
+        job.finish()
+        return get_seconds[2]
+
+
+def test_prefetch_overlaps_the_build_with_the_denoiser(sega, stubs, stub_model, builds, monkeypatch):
+        off = segment_get_seconds(sega, stubs, stub_model, monkeypatch)
+        assert not any(name.startswith('sega_prefetch') for name in builds)
+        assert off >= BUILD_SECONDS
+
+        builds.clear()
+        monkeypatch.setattr(sega, 'SEGA_PREFETCH', True)
+        on = segment_get_seconds(sega, stubs, stub_model, monkeypatch)
+        assert builds[0] == threading.current_thread().name
+        assert builds[1].startswith('sega_prefetch')
+        assert on < BUILD_SECONDS / 2
+
+
+def test_release_cancels_pending_prefetches(sega, stubs, stub_model, builds, blocked_worker, monkeypatch):
+        monkeypatch.setattr(sega, 'SEGA_PREFETCH', True)
+        job = make_job(sega, stubs, stub_model)
+        job.start()
+        concept_store = sega.sega_jobs.jobs[id(job.p)].concept_store
+        job.step(0)
+        job.step(1)
+        futures = list(concept_store.prefetches.values())
+        assert len(futures) == 1
+
+        job.finish()
+        assert concept_store.prefetches == {}
+        assert all(future.cancelled() for future in futures)
+        blocked_worker.set()
+        sega.get_prefetch_executor().submit(lambda: None).result()
+        assert builds == [threading.current_thread().name]
+
+
+def test_interrupt_stops_prefetching(sega, stubs, stub_model, builds, blocked_worker, monkeypatch):
+        monkeypatch.setattr(sega, 'SEGA_PREFETCH', True)
+        job = make_job(sega, stubs, stub_model)
+        job.start()
+        concept_store = sega.sega_jobs.jobs[id(job.p)].concept_store
+        job.step(0)
+        monkeypatch.setattr(stubs['modules.shared'].state, 'interrupted', True)
+        job.step(1)
+        assert concept_store.prefetches == {}
+        job.finish()
+
+
+def test_failed_job_cancels_pending_prefetches(sega, stubs, stub_model, builds, blocked_worker, monkeypatch):
+        monkeypatch.setattr(sega, 'SEGA_PREFETCH', True)
+        job = make_job(sega, stubs, stub_model)
+        job.start()
+        concept_store = sega.sega_jobs.jobs[id(job.p)].concept_store
+        job.step(0)
+        job.step(1)
+        futures = list(concept_store.prefetches.values())
+        assert len(futures) == 1
+
+        # an exception skips postprocess_batch, the job is released once p is garbage collected
+        del job
+        gc.collect()
+        assert sega.sega_jobs.jobs == {}
+        assert concept_store.prefetches == {}
+        assert all(future.cancelled() for future in futures)
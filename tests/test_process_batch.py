@@ -0,0 +1,54 @@
+import torch
+
+from benchmark_sega import BenchmarkJob, StubModel
+
+
+def guidance_params(job) -> tuple:
+        params = job.concept_state.sega_params[0]
+        return (params.warmup_period, params.edit_guidance_scale, params.tail_percentage_threshold, params.momentum_scale, params.momentum_beta, params.cooldown_period)
+
+
+def test_positional_arguments(sega, stubs):
+        stubs['modules.shared'].sd_model = StubModel('sd15', torch.float32, torch.device('cpu'))
+        script = sega.SegaExtensionScript()
+        p = stubs['modules.processing'].StableDiffusionProcessing(1, 20)
+
+        # the arguments of the first release keep their positions, later ones are optional
+        script.process_batch(p, True, 'concept 0', 'concept 1', 3, 2.0, 0.1, 0.25, 0.5)
+        job = sega.sega_jobs.jobs[id(p)]
+        assert guidance_params(job) == (3, 2.0, 0.1, 0.25, 0.5, -1)
+        assert [x.strength for x in job.concept_state.sega_params] == [1.0, -1.0]
+        assert job.concept_state.threshold_mode == "Gaussian"
+        assert job.guidance_space == "Embedding"
+
+        script.process_batch(p, True, 'concept 0', '', 3, 2.0, 0.1, 0.25, 0.5, 15, "Exact", "Noise")
+        job = sega.sega_jobs.jobs[id(p)]
+        assert guidance_params(job) == (3, 2.0, 0.1, 0.25, 0.5, 15)
+        assert job.concept_state.threshold_mode == "Exact"
+        assert job.guidance_space == "Noise"
+        script.postprocess_batch(p, None, None)
+
+
+def test_concepts_are_encoded_in_one_deduplicated_call(sega, stubs, stub_model, monkeypatch):
+        prompt_parser = stubs['modules.prompt_parser']
+        get_multicond_learned_conditioning = prompt_parser.get_multicond_learned_conditioning
+        calls = []
+
+        def recording_encode(model, prompts, *args, **kwargs):
+                calls.append(list(prompts))
+                return get_multicond_learned_conditioning(model, prompts, *args, **kwargs)
+
+        monkeypatch.setattr(prompt_parser, 'get_multicond_learned_conditioning', recording_encode)
+        config = {'model': stub_model.model, 'num_concepts': 3, 'concept_prompts': ['concept 0', 'concept 1', 'concept 0'], 'batch_size': 8, 'tokens': 77, 'steps': 4}
+        job = BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'neg_prompt': 'concept 2, concept 3', 'warmup': 0})
+        job.start()
+        assert calls == [['concept 0', 'concept 1', 'concept 2', 'concept 3']]
+
+        # each concept is encoded once and broadcast across the image batch without a copy
+        job.step(0)
+        (batch_tensor,) = sega.sega_jobs.jobs[id(job.p)].concept_store.batch_tensors.values()
+        for tensor in batch_tensor.values():
+                assert tensor.shape[:2] == (5, 8)
+                assert tensor.stride(1) == 0
+        assert [x.strength for x in sega.sega_jobs.jobs[id(job.p)].concept_state.sega_params] == [1.0, 1.0, 1.0, -1.0, -1.0]
+        job.finish()
@@ -0,0 +1,108 @@
+import torch
+
+
+class FakeAllocator:
+        """ torch.cuda memory stats of a single device, without a GPU """
+        def __init__(self, device: torch.device, allocated: int, peak: int):
+                self.device = device
+                self.allocated = allocated
+                self.peak = peak
+                self.calls = 0
+
+        def allocate(self, nbytes: int):
+                self.allocated += nbytes
+                self.peak = max(self.peak, self.allocated)
+
+        def install(self, monkeypatch):
+                def check_device(device):
+                        self.calls += 1
+                        assert torch.device(device) == self.device
+                def reset_peak_memory_stats(device=None):
+                        raise AssertionError('device-wide peak memory stats must not be reset')
+                def memory_allocated(device=None):
+                        check_device(device)
+                        return self.allocated
+                def max_memory_allocated(device=None):
+                        check_device(device)
+                        return self.peak
+                monkeypatch.setattr(torch.cuda, 'synchronize', check_device)
+                monkeypatch.setattr(torch.cuda, 'memory_allocated', memory_allocated)
+                monkeypatch.setattr(torch.cuda, 'max_memory_allocated', max_memory_allocated)
+                monkeypatch.setattr(torch.cuda, 'reset_peak_memory_stats', reset_peak_memory_stats)
+
+
+def test_profiler_measures_the_given_device_without_resetting_peaks(sega, monkeypatch):
+        device = torch.device('cuda:1')
+        allocator = FakeAllocator(device, allocated=1000, peak=5000)
+        allocator.install(monkeypatch)
+        profiler = sega.SegaProfiler(1, enabled=True)
+
+        # below the device peak, e.g. set by the denoiser, the allocation is still sampled
+        with profiler.step(device):
+                allocator.allocate(2000)
+                profiler.sample()
+                allocator.allocate(-2000)
+        assert profiler.peak_allocated_bytes == 2000
+
+        with profiler.step(device):
+                allocator.allocate(6000)
+                profiler.sample()
+                allocator.allocate(-6000)
+        assert profiler.peak_allocated_bytes == 6000
+        assert allocator.peak == 7000
+        assert profiler.report()['steps'] == 2
+
+        # outside of a step nothing is sampled
+        allocator.allocate(10000)
+        profiler.sample()
+        assert profiler.peak_allocated_bytes == 6000
+
+
+def test_profiler_samples_every_chunk(sega, monkeypatch):
+        device = torch.device('cuda:0')
+        allocator = FakeAllocator(device, allocated=0, peak=0)
+        allocator.install(monkeypatch)
+        # a chunk per concept, and every chunk keeps its edit direction allocated until the edit is done
+        monkeypatch.setattr(sega, 'SEGA_MEMORY_BUDGET_MB', 1e-6)
+        run_guidance_kernel = sega.run_guidance_kernel
+
+        def allocating_kernel(*args, **kwargs):
+                allocator.allocate(1000)
+                return run_guidance_kernel(*args, **kwargs)
+
+        monkeypatch.setattr(sega, 'run_guidance_kernel', allocating_kernel)
+        sega_params = [sega.SegaStateParams() for _ in range(3)]
+        concept_state = sega.SegaConceptState(sega_params)
+        profiler = sega.SegaProfiler(len(sega_params), enabled=True)
+        concept_cond = torch.randn((3, 1, 77, 8))
+        with profiler.step(device):
+                sega.SegaExtensionScript().sega_dense_edit('crossattn', concept_cond, torch.zeros((1, 77, 8)), concept_state, None, profiler.stats, profiler=profiler)
+                allocator.allocate(-3000)
+        assert profiler.peak_allocated_bytes == 3000
+
+
+def test_profiler_skips_cuda_stats_on_cpu(sega, monkeypatch):
+        allocator = FakeAllocator(torch.device('cuda:0'), allocated=0, peak=0)
+        allocator.install(monkeypatch)
+        profiler = sega.SegaProfiler(1, enabled=True)
+        with profiler.step(torch.device('cpu')):
+                pass
+        with profiler.step(torch.device('cpu'), count=False):
+                pass
+        assert allocator.calls == 0
+        assert profiler.peak_allocated_bytes is None
+        assert profiler.report()['steps'] == 1
+
+
+def test_tail_fraction_is_counted_in_integers(sega):
+        # float64 reductions are unsupported on mps, the counts stay int64 on the device
+        profiler = sega.SegaProfiler(2, enabled=True)
+        concept_cond = torch.arange(8, dtype=torch.float32).view(2, 1, 4)
+        uncond = torch.zeros((1, 4))
+        ones = torch.ones((2, 1, 1))
+        upper_threshold = torch.full((2, 1, 1), 2.5)
+        sega.sega_guidance_kernel(concept_cond, uncond, torch.zeros_like(concept_cond), ones, ones, ones, ones, ones, profile_stats=profiler.stats, upper_threshold=upper_threshold)
+        sega.sega_sparse_guidance_kernel(concept_cond, uncond, ones, ones, ones, profile_stats=profiler.stats, upper_threshold=upper_threshold)
+        assert profiler.stats['selected_elements'].dtype == torch.int64
+        assert int(profiler.stats['selected_elements']) == 10
+        assert profiler.report()['tail_fraction'] == 0.625
@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from benchmark_sega import BenchmarkJob
+
+STEPS = 4
+
+
+def run_job(sega, stubs, model, monkeypatch, sparse_density: float, tail_percentage_threshold: float, threshold_mode: str = "Exact", step_density: float = None) -> tuple:
+        monkeypatch.setattr(sega, 'SEGA_SPARSE_DENSITY', sparse_density)
+        # a concept with its own warmup masks it out of the first steps
+        config = {'model': model.model, 'num_concepts': 2, 'concept_prompts': ['concept 0', '(concept 1:1.5) {warmup=2}'], 'batch_size': 2, 'tokens': 77, 'steps': STEPS}
+        job = BenchmarkJob(sega, stubs, config, torch.device('cpu'), {'neg_prompt': 'concept 2', 'warmup': 0, 'tail_percentage_threshold': tail_percentage_threshold, 'threshold_mode': threshold_mode})
+        job.start()
+        if step_density is not None:
+                # the density the sampled steps are checked against, after the initial choice of job.start
+                monkeypatch.setattr(sega, 'SEGA_SPARSE_DENSITY', step_density)
+        concept_state = sega.sega_jobs.jobs[id(job.p)].concept_state
+        outputs, sparse = [], []
+        for i in range(STEPS):
+                sparse.append(concept_state.sparse)
+                params = job.step(i)
+                outputs.append(params.text_cond if isinstance(params.text_cond, dict) else {'crossattn': params.text_cond})
+        job.finish()
+        return outputs, sparse
+
+
+@pytest.mark.parametrize('threshold_mode', ["Exact", "Approximate"])
+@pytest.mark.parametrize('tail_percentage_threshold', [0.001, 0.01])
+def test_sparse_matches_dense(sega, stubs, stub_model, monkeypatch, tail_percentage_threshold, threshold_mode):
+        dense, dense_steps = run_job(sega, stubs, stub_model, monkeypatch, 0, tail_percentage_threshold, threshold_mode)
+        # 1 never switches the sparse path over to dense
+        sparse, sparse_steps = run_job(sega, stubs, stub_model, monkeypatch, 1, tail_percentage_threshold, threshold_mode)
+        assert not any(dense_steps)
+        assert all(sparse_steps)
+        for step in range(STEPS):
+                for key in dense[step]:
+                        assert torch.allclose(sparse[step][key], dense[step][key], rtol=1e-5, atol=1e-5), f'step {step}, {key}'
+
+
+def test_gaussian_threshold_starts_dense(sega, stubs, stub_model, monkeypatch):
+        # the Gaussian threshold selects far more than its tail percentage of the stub conditioning
+        _, steps = run_job(sega, stubs, stub_model, monkeypatch, 1, 0.001, "Gaussian")
+        assert not any(steps)
+
+
+def test_sparse_switches_to_dense(sega, stubs, stub_model, monkeypatch):
+        dense, _ = run_job(sega, stubs, stub_model, monkeypatch, 0, 0.01)
+        # more than half a percent of the elements get selected, so the first step switches to dense
+        switched, switched_steps = run_job(sega, stubs, stub_model, monkeypatch, 0.01, 0.01, step_density=0.005)
+        assert switched_steps == [True] + [False] * (STEPS - 1)
+        for step in range(STEPS):
+                for key in dense[step]:
+                        assert torch.allclose(switched[step][key], dense[step][key], rtol=1e-5, atol=1e-5), f'step {step}, {key}'
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+STRENGTHS = [1.0, -1.0, 0.5]
+
+
+def make_state(sega, tail_percentage_threshold: float, threshold_mode: str):
+        sega_params = []
+        for strength in STRENGTHS:
+                params = sega.SegaStateParams()
+                params.tail_percentage_threshold = tail_percentage_threshold
+                params.strength = strength
+                sega_params.append(params)
+        return sega.SegaConceptState(sega_params, threshold_mode)
+
+
+def make_conds(shape: tuple) -> tuple:
+        generator = torch.Generator().manual_seed(1)
+        concept_cond = torch.randn((len(STRENGTHS),) + shape, generator=generator)
+        uncond = torch.randn(shape, generator=generator)
+        return concept_cond, uncond
+
+
+def selected_elements(concept_state, concept_cond, uncond, threshold) -> list[int]:
+        strength = concept_state.tensors(concept_cond)['strength']
+        return torch.sub(concept_cond, uncond).mul_(strength).abs_().gt_(threshold).flatten(1).sum(1).tolist()
+
+
+@pytest.mark.parametrize('tail_percentage_threshold', [0.0, 0.001, 0.05, 0.5, 1.0])
+def test_exact_selects_the_tail_percentage(sega, tail_percentage_threshold):
+        concept_state = make_state(sega, tail_percentage_threshold, "Exact")
+        concept_cond, uncond = make_conds((2, 77, 64))
+        threshold = concept_state.tail_threshold('crossattn', 0, concept_cond, uncond)
+        num_elements = uncond.nelement()
+        assert selected_elements(concept_state, concept_cond, uncond, threshold) == [round(tail_percentage_threshold * num_elements)] * len(STRENGTHS)
+
+
+@pytest.mark.parametrize('tail_percentage_threshold', [0.01, 0.05, 0.2])
+def test_approximate_is_close_to_exact(sega, tail_percentage_threshold):
+        # more elements than SEGA_THRESHOLD_SAMPLES, so the threshold is estimated from a sample
+        concept_cond, uncond = make_conds((2, 77, 2048))
+        assert uncond.nelement() > sega.SEGA_THRESHOLD_SAMPLES
+        exact_state = make_state(sega, tail_percentage_threshold, "Exact")
+        approximate_state = make_state(sega, tail_percentage_threshold, "Approximate")
+        exact = exact_state.tail_threshold('crossattn', 0, concept_cond, uncond)
+        approximate = approximate_state.tail_threshold('crossattn', 0, concept_cond, uncond)
+
+        # within 2% of the exact threshold, and within 10% of the tail percentage for thresholds of 0.01 and above
+        assert torch.allclose(approximate, exact, rtol=0.02, atol=0)
+        target = tail_percentage_threshold * uncond.nelement()
+        for selected in selected_elements(approximate_state, concept_cond, uncond, approximate):
+                assert abs(selected - target) <= 0.1 * target
+
+
+def test_approximate_threshold_is_refreshed(sega, monkeypatch):
+        monkeypatch.setattr(sega, 'SEGA_THRESHOLD_SAMPLES', 1024)
+        concept_cond, uncond = make_conds((1, 77, 64))
+        concept_state = make_state(sega, 0.05, "Approximate")
+        threshold = concept_state.tail_threshold('crossattn', 0, concept_cond, uncond)
+        assert concept_state.tail_threshold('crossattn', sega.SEGA_THRESHOLD_REFRESH - 1, concept_cond, uncond) is threshold
+        assert concept_state.tail_threshold('crossattn', sega.SEGA_THRESHOLD_REFRESH, concept_cond, uncond) is not threshold
+        # a new concept tensor, i.e. a scheduled concept prompt that changed
+        assert concept_state.tail_threshold('crossattn', sega.SEGA_THRESHOLD_REFRESH, concept_cond.clone(), uncond) is not threshold